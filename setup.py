@@ -24,8 +24,9 @@ setuptools.setup(
         "owslib",
         "numpy",
         "rtree",
-        "contextily",
 	"xyzservices",
+        "requests",
+        "httpx[http2]",
         "click"
     ],
     entry_points={
@@ -33,6 +34,8 @@ setuptools.setup(
             'wcs = terrainy.connection_wcs:WcsConnection',
             'wms = terrainy.connection_wms:WmsConnection',
             'tile = terrainy.connection_tile:TileConnection',
+            'file = terrainy.connection_file:FileConnection',
+            'vrt = terrainy.connection_file:FileConnection',
         ],
         'console_scripts': [
             'terrainy = terrainy.cmd:main',
@@ -1,26 +1,67 @@
-import rasterio
-import rasterio.mask
-import rasterio
-import rasterio.mask
-from rasterio.transform import Affine
-import rasterio.rio.clip
-
-import geopandas as gpd
-import pkg_resources
-import shapely
-from shapely.geometry import box, mapping
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import glob
+import importlib
 import json
-
-from . import connection
-from . import sources
-
-
-def download(gdf, title, tif_res):
-    "Downloads raster data for a shape from a given source"
-    data = sources.load().loc[title]
-    con = connection.connect(**data)
-    return con.download(gdf, tif_res)
+import os
+
+# Submodules, and the heavy libraries they use (rasterio, geopandas,
+# owslib), are only imported when first used, so that importing
+# terrainy (e.g. for the command line tool) is fast.
+_submodules = {"benchmark", "cache", "capabilities", "cmd", "composite", "connection", "instrument", "job",
+               "mirror", "mockserver", "mosaic", "proxy", "sources", "warp", "xyz"}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def download(gdf, title, tif_res, cache=True, workers=None, out_path=None, buffer=None, snap=False, resume=False,
+             callback=None):
+    """Downloads raster data for a shape from a given source.
+    cache is passed on to the connection, see connection.Connection.
+    workers is the number of tiles to download in parallel. If out_path
+    is given, the raster is streamed to a GeoTIFF file there instead of
+    being held in memory. Only tiles intersecting the shape, buffered
+    by buffer, are downloaded. With snap, tif_res is snapped to the
+    native grid of the source, see connection.Connection.get_grid().
+    With resume, a download to out_path that was interrupted or had
+    failed tiles is picked up where it left off. Progress is reported
+    to callback, and timings are returned as "stats", see
+    instrument.Stats.
+
+    title can also be a list of titles, in priority order. Each part
+    of the shape is then downloaded from the first source covering
+    it, and gaps are filled from the next ones, see
+    composite.download() (snap and resume are not supported)."""
+    from . import composite, connection, sources
+    if isinstance(title, (list, tuple)):
+        if snap or resume:
+            raise NotImplementedError("snap and resume are not supported for several sources")
+        return composite.download(sources.catalog().loc[list(title)], gdf, tif_res, cache=cache, workers=workers,
+                                  out_path=out_path, buffer=buffer, callback=callback)
+    data = sources.get(title)
+    con = connection.connect(cache=cache, **data)
+    return con.download(gdf, tif_res, workers=workers, out_path=out_path, buffer=buffer, snap=snap,
+                        resume=resume, callback=callback)
+
+
+def download_many(gdf, title, tif_res, out_dir=None, cache=True, workers=None, buffer=None, snap=False,
+                  callback=None):
+    """Downloads one raster per feature of gdf from a given source,
+    using a single connection. Tiles shared by overlapping features
+    are downloaded once. If out_dir is given, each raster is streamed
+    to a GeoTIFF there, named after the index of its feature. Returns
+    a list of results, one per feature, like download()."""
+    from . import connection, sources
+    data = sources.get(title)
+    con = connection.connect(cache=cache, **data)
+    out_paths = None
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        out_paths = [os.path.join(out_dir, "%s.tif" % idx) for idx in gdf.index]
+    return con.download_many(gdf, tif_res, workers=workers, out_paths=out_paths, buffer=buffer, snap=snap,
+                             callback=callback)
 
 
 def getFeatures(gdf):
@@ -29,6 +70,9 @@ def getFeatures(gdf):
 
 
 def clip_to_area(file, area, to_bounds=True):
+    import rasterio
+    import rasterio.mask
+    import shapely.geometry
     with rasterio.open(file) as src:
         area = area.to_crs(src.crs)
         if to_bounds:
@@ -52,6 +96,8 @@ def getFeatures(gdf):
 
 
 def geom_to_gdf(geom, geom_crs, buffer=None):
+    import geopandas as gpd
+    from shapely.geometry import mapping
     feature_coll = {
         "type": "FeatureCollection",
         "features": [
@@ -75,6 +121,8 @@ def geom_to_gdf(geom, geom_crs, buffer=None):
 
 
 def crop_raster(file, geom, geom_crs, buffer=None, driver=None):
+    import rasterio
+    import rasterio.mask
     if driver:
         driver = driver
     else:
@@ -94,95 +142,78 @@ def crop_raster(file, geom, geom_crs, buffer=None, driver=None):
         dest.write(out_image)
 
 
-def reproject_raster_to_project_crs(filename, out_crs, resampling=None):
+def reproject_raster_to_project_crs(filename, out_crs, resampling=None, workers=None, memory=None):
     """ reproject an image to a new crs:
         inputs:
         filename: string, path to file to reproject
-        out_crs: int, epsg code of destination crs"""
+        out_crs: int, epsg code of destination crs
+
+    The file is reprojected window by window in parallel, with at most
+    memory bytes of it in memory at a time, see
+    warp.reproject_windows(), and then replaced, along with its
+    sidecar files (e.g. the .aux.xml holding the georeferencing of a
+    PNG)."""
+    from . import warp
     dst_crs = ('EPSG:' + str(out_crs))
+    tmpname = os.path.join(os.path.dirname(os.path.abspath(filename)), ".tmp-" + os.path.basename(filename))
+    try:
+        warp.reproject_file(filename, tmpname, dst_crs, resampling, workers, memory)
+        warp.replace_dataset(tmpname, filename)
+    finally:
+        # What is left of the temporary file and its sidecar files
+        for name in glob.glob(glob.escape(tmpname) + "*"):
+            os.remove(name)
+
+
+def export(data_dict, out_path, out_crs, crop_geom=None, crop_geom_crs=None, buffer=None, driver=None, resampling=None,
+           compress=None, predictor=None, overviews=None, callback=None, workers=None, memory=None):
+    """Writes the result of download() to out_path, reprojected to
+    out_crs and optionally cropped to crop_geom, buffered by buffer.
+
+    driver is "GTiff" (default), "COG" for a Cloud Optimized GeoTIFF
+    with internal overviews, "VRT" for one GeoTIFF per tile plus a VRT
+    mosaic at out_path, or "PNG". compress ("deflate", "zstd", "lzw"
+    or "none"), predictor and overviews apply to the GeoTIFF based
+    formats.
+
+    Returns a summary of the time taken by each stage; the stages are
+    also reported to callback as they finish, see instrument.Stats.
+
+    data_dict can hold the mosaic either in memory ("array") or in a
+    file ("path", see download(..., out_path=...)). Reprojection,
+    cropping and writing are done in a single pass, window by window,
+    by workers threads with at most memory bytes of the raster in
+    memory, see warp.export_raster()."""
+    import geopandas as gpd
+    from . import warp
+    dst_crs = 'EPSG:' + str(out_crs)
+
+    if crop_geom is not None:
+        crop = gpd.GeoSeries([crop_geom], crs=crop_geom_crs)
+        if buffer is not None:
+            crop = crop.buffer(buffer, resolution=2, join_style=3)
+        crop_geom = crop.to_crs(dst_crs).iloc[0]
 
-    if not resampling:
-        resampling = Resampling.nearest
-
-    with rasterio.open(filename) as src:
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-        bands = [src.read(i) for i in range(1, src.count + 1)]
-        src_crs = src.crs
-        dst_transform = transform
-
-    with rasterio.open(filename, 'w', **kwargs) as dst:
-        for i, band in enumerate(bands):
-            reproject(
-                source=band,
-                destination=rasterio.band(dst, i + 1),
-                src_transform=src.transform,
-                src_crs=src_crs,
-                dst_transform=dst_transform,
-                dst_crs=dst_crs,
-                resampling=resampling)
-
-
-def export(data_dict, out_path, out_crs, crop_geom=None, crop_geom_crs=None, buffer=None, driver=None, resampling=None):
     if driver == "PNG":
-        ras_meta = {
-            'driver': 'PNG',
-            'height': data_dict["array"].shape[1],
-            'width': data_dict["array"].shape[2],
-            'count': 3,
-            'crs': data_dict["data"]["crs_orig"],
-            'dtype': data_dict["array"].dtype,
-            'transform': data_dict["transform"],
-            'nodata': 0
-        }
-
-        with rasterio.open(out_path, 'w', **ras_meta) as png:
-            png.write(data_dict["array"][0:3])
-
-        reproject_raster_to_project_crs(out_path, out_crs, resampling=resampling)
-        if crop_geom is not None:
-            crop_raster(out_path, crop_geom, crop_geom_crs, buffer=buffer, driver="PNG")
-
-
-    else:
-        ras_meta = {'driver': 'GTiff',
-                    'dtype': data_dict["array"].dtype,
-                    'nodata': None,
-                    'width': data_dict["array"].shape[2],
-                    'height': data_dict["array"].shape[1],
-                    'count': data_dict["array"].shape[0],
-                    'crs': data_dict["data"]["crs_orig"],
-                    'transform': data_dict["transform"],
-                    'tiled': False,
-                    'interleave': 'band'}
-
-        with rasterio.open(out_path, 'w', **ras_meta) as tif:
-            tif.write(data_dict["array"])
-
-        reproject_raster_to_project_crs(out_path, out_crs, resampling=resampling)
-
-        if crop_geom is not None:
-            crop_raster(out_path, crop_geom, crop_geom_crs, buffer=buffer, driver="GTiff")
+        return warp.export_raster(data_dict, out_path, dst_crs, crop_geom=crop_geom, bands=[1, 2, 3],
+                                  driver="PNG", resampling=resampling, nodata=0, callback=callback,
+                                  workers=workers, memory=memory)
+    return warp.export_raster(data_dict, out_path, dst_crs, crop_geom=crop_geom,
+                              driver=driver or "GTiff", resampling=resampling,
+                              compress=compress, predictor=predictor, overviews=overviews,
+                              callback=callback, workers=workers, memory=memory)
 
 
 def get_maps(gdf):
     "Returns the available map sources available from your input shapefile"
-    s = sources.load()
-    s = s.loc[s.geometry.is_valid]
-    return s.loc[s.contains(gdf["geometry"][0])]
+    from . import sources
+    return sources.covering(gdf["geometry"][0])
 
 
 def choose_map(title):
     "Returns the shape you want to use to get data from, based on the title"
-    s = sources.load()
-    return s.loc[s["title"] == title]
+    from . import sources
+    return sources.catalog().loc[[title]]
 
 
 # Legacy names
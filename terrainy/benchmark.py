@@ -0,0 +1,209 @@
+"""Benchmarks of downloads, exports, reprojection and source catalog
+lookups, run against a local mock server (see mockserver.py) so that
+results only depend on terrainy itself and the configured server
+latency. Results are written as JSON, to be compared across releases:
+
+    terrainy benchmark --output benchmark.json
+"""
+import contextlib
+import datetime
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import geopandas as gpd
+import shapely.geometry
+import terrainy
+from . import capabilities
+from . import connection
+from . import instrument
+from . import mockserver
+from . import sources
+
+# Every download scenario is a variation of one parameter of the
+# baseline. size is the width and height of the area of interest in
+# meters, format the export output format (None to not export).
+baseline = {"source": "wcs", "size": 4000, "resolution": 2, "workers": 4, "format": None}
+
+variations = {
+    "source": ["wms", "tile"],
+    "size": [1000, 16000],
+    "resolution": [1, 8],
+    "workers": [1, 16],
+    "format": ["GTiff", "COG", "VRT"],
+}
+
+# Center of the areas of interest, in mockserver.crs
+center = (550000, 6650000)
+
+
+def scenario_name(params):
+    return ",".join("%s=%s" % (key, params[key]) for key in sorted(params))
+
+
+def default_scenarios():
+    "Returns the list of scenarios run by default: download scenarios, reprojection and catalog lookups"
+    scenarios = [dict(baseline, kind="download")]
+    for key, values in variations.items():
+        for value in values:
+            scenarios.append(dict(baseline, kind="download", **{key: value}))
+    scenarios.append({"kind": "reproject", "size": baseline["size"], "resolution": baseline["resolution"]})
+    scenarios.append({"kind": "sources"})
+    return scenarios
+
+
+def area(size):
+    "A GeoDataFrame with a size x size meter square around center"
+    x, y = center
+    return gpd.GeoDataFrame(geometry=[shapely.geometry.box(x - size / 2, y - size / 2, x + size / 2, y + size / 2)],
+                            crs=mockserver.crs)
+
+
+class Timer(object):
+    "Collects the run time of named stages"
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+
+def run_download(server, scenario, tmpdir, timer):
+    con = connection.connect(cache=None, **server.source(scenario["source"]))
+    with timer.stage("download"):
+        res = con.download(area(scenario["size"]), scenario["resolution"], workers=scenario["workers"])
+    info = {"tiles": int(res["valid_tiles"].sum()),
+            "pixels": int(res["array"].shape[1] * res["array"].shape[2]),
+            "stats": res["stats"]}
+    if scenario["format"] is not None:
+        out_path = os.path.join(tmpdir, "export.vrt" if scenario["format"] == "VRT" else "export.tif")
+        with timer.stage("export"):
+            info["export_stats"] = terrainy.export(res, out_path, 32633, driver=scenario["format"])
+        info["output_bytes"] = sum(os.path.getsize(os.path.join(dirpath, name))
+                                   for dirpath, dirnames, names in os.walk(tmpdir) for name in names)
+    return info
+
+
+def run_reproject(server, scenario, tmpdir, timer):
+    con = connection.connect(cache=None, **server.source("wcs"))
+    res = con.download(area(scenario["size"]), scenario["resolution"])
+    filename = os.path.join(tmpdir, "reproject.tif")
+    terrainy.export(res, filename, 25833)
+    with timer.stage("reproject"):
+        terrainy.reproject_raster_to_project_crs(filename, 32633)
+    return {"pixels": int(res["array"].shape[1] * res["array"].shape[2])}
+
+
+def mock_catalog(server, path):
+    """Writes a source catalog with the sources of the mock server to
+    path, so that catalog benchmarks do not depend on the catalog of
+    the user"""
+    coverage = gpd.GeoSeries([shapely.geometry.box(*mockserver.bounds)], crs=mockserver.crs).to_crs(4326).iloc[0]
+    rows = [dict(server.source(connection_type), geometry=coverage) for connection_type in ("wcs", "wms", "tile")]
+    gpd.GeoDataFrame(rows, crs=4326).to_file(path, driver="GeoJSON")
+
+
+def run_sources(server, scenario, tmpdir, timer):
+    with timer.stage("load"):
+        catalog = sources.load()
+    point = gpd.GeoSeries([shapely.geometry.Point(*center)], crs=mockserver.crs).to_crs(4326).iloc[0]
+    with timer.stage("covering"):
+        sources.covering(point)
+    return {"sources": len(catalog)}
+
+
+runners = {"download": run_download, "reproject": run_reproject, "sources": run_sources}
+
+
+@contextlib.contextmanager
+def quieted():
+    "Hides the messages terrainy logs below warnings"
+    level = instrument.logger.level
+    instrument.logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        instrument.logger.setLevel(level)
+
+
+def summarize(values):
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+def run(scenarios=None, repeat=3, latency=0.05, tile_size=256, max_size=4096, only=None, quiet=True):
+    """Runs scenarios (default: default_scenarios()) repeat times each
+    against a mock server with the given latency (seconds per tile
+    request), XYZ tile_size and WCS / WMS max_size. only limits the
+    run to scenarios whose name contains it. Returns the results as a
+    dictionary, see write()."""
+    if scenarios is None:
+        scenarios = default_scenarios()
+    results = []
+    # Keep the capabilities of the mock server out of the user's cache,
+    # and use a catalog of its sources rather than the user's
+    saved_capabilities_dir = capabilities.capabilities_dir
+    saved_sources_paths = sources.package_sources_path, sources.sources_path
+    capabilities.capabilities_dir = tempfile.mkdtemp(prefix="terrainy-benchmark-")
+    try:
+        with mockserver.MockServer(latency=latency, tile_size=tile_size, max_size=max_size) as server:
+            sources.package_sources_path = os.path.join(capabilities.capabilities_dir, "sources.geojson")
+            sources.sources_path = os.path.join(capabilities.capabilities_dir, "user-sources.geojson")
+            mock_catalog(server, sources.package_sources_path)
+            for scenario in scenarios:
+                name = scenario_name(scenario)
+                if only is not None and only not in name:
+                    continue
+                runs = []
+                for idx in range(repeat):
+                    tmpdir = tempfile.mkdtemp(prefix="terrainy-benchmark-")
+                    timer = Timer()
+                    server.reset()
+                    try:
+                        with quieted() if quiet else contextlib.nullcontext():
+                            info = runners[scenario["kind"]](server, scenario, tmpdir, timer)
+                    finally:
+                        shutil.rmtree(tmpdir, ignore_errors=True)
+                    info.update({"requests": server.requests, "bytes": server.bytes, "seconds": timer.stages})
+                    runs.append(info)
+                stages = {stage: summarize([run["seconds"][stage] for run in runs]) for stage in runs[0]["seconds"]}
+                result = {"name": name, "scenario": scenario, "runs": runs, "seconds": stages}
+                results.append(result)
+                instrument.logger.info("%-70s %s", name, " ".join("%s=%.3fs" % (stage, summary["median"])
+                                                                  for stage, summary in stages.items()))
+    finally:
+        shutil.rmtree(capabilities.capabilities_dir, ignore_errors=True)
+        capabilities.capabilities_dir = saved_capabilities_dir
+        sources.package_sources_path, sources.sources_path = saved_sources_paths
+        sources.invalidate()
+
+    try:
+        version = importlib.metadata.version("terrainy")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return {"terrainy_version": version,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "server": {"latency": latency, "tile_size": tile_size, "max_size": max_size},
+            "repeat": repeat,
+            "results": results}
+
+
+def write(results, path):
+    """Writes the results of run() to path as JSON. The run times of
+    each stage of a scenario are summarized in results[i]["seconds"]
+    as min / median / max over the repeated runs."""
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
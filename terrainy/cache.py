@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Default byte budget of a tile cache
+default_max_bytes = 2 * 1024 ** 3
+
+# When evicting, shrink the cache to this fraction of the budget so
+# that we don't have to rescan the cache directory on every put.
+evict_target = 0.9
+
+
+def key(**kw):
+    "Returns the cache key for a set of tile parameters"
+    return hashlib.sha256(json.dumps(kw, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class TileCache(object):
+    """Content addressed, size bounded on-disk cache of raw tile
+    responses.
+
+    Entries are stored as one file each, named by a hash of the tile
+    parameters. Files are written atomically (write to a temporary
+    file, then rename), so several processes can share one cache
+    directory. Least recently used entries (by file mtime, which is
+    touched on every hit) are evicted when the cache grows beyond
+    max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=default_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    key = staticmethod(key)
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        "Returns the cached bytes for key, or None"
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            # Evicted by another process after we read it
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        filename = self.filename(key)
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # The size of the entry this replaces, if any
+            try:
+                replaced = os.stat(filename).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmpname, filename)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmpname)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += len(data) - replaced
+            full = self._size > self.max_bytes
+        if full:
+            # The running size only counts the puts of this process,
+            # others might have evicted entries in the meantime
+            size = self.size()
+            with self._lock:
+                self._size = size
+            if size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        "Returns a list of (mtime, size, filename) for all cache entries"
+        res = []
+        if not os.path.exists(self.path):
+            return res
+        for dirname in os.listdir(self.path):
+            dirpath = os.path.join(self.path, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for name in os.listdir(dirpath):
+                if name.startswith(".tmp-"):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                res.append((st.st_mtime, st.st_size, filename))
+        return res
+
+    def size(self):
+        "Total size of the cache in bytes"
+        return sum(size for mtime, size, filename in self.entries())
+
+    @contextlib.contextmanager
+    def locked(self):
+        "Exclusive lock on the cache directory, shared between processes"
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self, max_bytes=None):
+        "Removes least recently used entries until the cache fits in max_bytes"
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self.locked():
+            entries = sorted(self.entries())
+            size = sum(entry[1] for entry in entries)
+            if size > max_bytes:
+                target = max_bytes * evict_target
+                for mtime, entry_size, filename in entries:
+                    if size <= target:
+                        break
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(filename)
+                    size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "max_bytes": self.max_bytes}
+
+
+class TileMemo(object):
+    """In memory store for tiles that are needed several times within
+    one job, e.g. by overlapping features in
+    Connection.download_many(). uses maps tile keys to the number of
+    times each tile will be requested. A tile is kept in memory only
+    until it has been used that many times."""
+
+    def __init__(self, uses):
+        self.uses = dict(uses)
+        self.tiles = {}
+        self.lock = threading.Lock()
+
+    def use(self, key):
+        self.uses[key] = self.uses.get(key, 1) - 1
+        if self.uses[key] <= 0:
+            self.uses.pop(key, None)
+            self.tiles.pop(key, None)
+
+    def get(self, key):
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.use(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if self.uses.get(key, 0) > 1:
+                self.tiles[key] = data
+            self.use(key)
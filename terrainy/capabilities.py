@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import requests
+from . import connection
+from . import instrument
+
+capabilities_dir = os.path.join(connection.cachedir, "capabilities")
+
+# Cached capabilities documents younger than this (in seconds) are
+# used without asking the server. Older ones are revalidated with a
+# conditional request.
+ttl = 24 * 60 * 60
+
+
+def filenames(url):
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(capabilities_dir, name + ".xml"), os.path.join(capabilities_dir, name + ".json")
+
+
+def write_atomic(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmpname, filename)
+
+
+def get(url, headers=None, timeout=30, auth=None):
+    """Returns the capabilities document at url (a full GetCapabilities
+    request url), from the on-disk cache if it is younger than ttl.
+    Stale documents are revalidated using the ETag / Last-Modified
+    headers of the original response, and used as is if the server
+    can not be reached."""
+    xml_filename, meta_filename = filenames(url)
+    meta = None
+    if os.path.exists(xml_filename) and os.path.exists(meta_filename):
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        if time.time() - meta["fetched"] < ttl:
+            with open(xml_filename, "rb") as f:
+                return f.read()
+
+    request_headers = dict(headers or {})
+    if meta is not None:
+        if meta.get("etag"):
+            request_headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            request_headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = requests.get(url, headers=request_headers, timeout=timeout, auth=auth)
+        if response.status_code != 304:
+            response.raise_for_status()
+    except requests.RequestException as e:
+        if meta is None:
+            raise
+        instrument.logger.warning("Unable to revalidate capabilities for %s, using cached copy: %s", url, e)
+        with open(xml_filename, "rb") as f:
+            return f.read()
+
+    if response.status_code == 304:
+        with open(xml_filename, "rb") as f:
+            xml = f.read()
+    else:
+        xml = response.content
+        write_atomic(xml_filename, xml)
+        meta = {"etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")}
+    meta["fetched"] = time.time()
+    write_atomic(meta_filename, json.dumps(meta).encode("utf-8"))
+    return xml
+
+
+def clear():
+    if not os.path.exists(capabilities_dir):
+        return
+    for name in os.listdir(capabilities_dir):
+        os.unlink(os.path.join(capabilities_dir, name))
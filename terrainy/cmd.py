@@ -1,19 +1,25 @@
 import click
-import pandas as pd
-import geopandas as gpd
 import json
-import yaml
+import logging
+import os
 
-from . import sources
-from . import connection
-
-pd.set_option('display.max_columns', None)
-pd.set_option("display.max_rows", None)
-pd.set_option('display.expand_frame_repr', False)
+# The modules of terrainy and the libraries they use are imported by
+# the commands that need them, so that the command line tool starts
+# quickly.
 
 @click.group()
 def main():
-    pass
+    # Messages of the library go to stderr, keeping stdout clean for
+    # pipelines
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("terrainy")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+def quiet_logging():
+    "Only show warnings and errors of the library"
+    logging.getLogger("terrainy").setLevel(logging.WARNING)
 
 @main.group()
 def source():
@@ -25,6 +31,11 @@ def source():
 # @click.argument('input', type=str)
 # @click.argument('output', type=str)
 def list(long=False):
+    import pandas as pd
+    from . import sources
+    pd.set_option('display.max_columns', None)
+    pd.set_option("display.max_rows", None)
+    pd.set_option('display.expand_frame_repr', False)
     s = sources.load()
     #s = s.join(s.geometry.bounds)
     s["bbox"] = s.geometry.bounds.apply(lambda row: "%(minx).4f,%(miny).4f,%(maxx).4f,%(maxy).4f" % row, axis=1)
@@ -46,12 +57,140 @@ def list(long=False):
 @click.argument('connection_args', type=str)
 @click.argument('layer', type=str)
 def add(**kw):
+    from . import sources
     kw["connection_args"] = json.loads(kw["connection_args"])
     sources.add_source(**kw)
     
 @source.command()
 @click.argument('yamlfile', type=str)
 def add_mapproxy(yamlfile):
+    import yaml
+    from . import sources
     with open(yamlfile) as f:
         data = yaml.load(f, Loader=yaml.Loader)
     sources.add_mapproxy(data)
+
+@source.command()
+@click.argument('title', type=str)
+@click.option('--res', default=1.0, type=float, help='Resolution to measure at, in the units of the source crs')
+def tune(title, res):
+    from . import sources
+    sources.tune_tile_size(title, res)
+
+@main.group()
+def cache():
+    pass
+
+@cache.command()
+def info():
+    from . import connection
+    c = connection.tile_cache
+    print("Path: %s" % c.path)
+    print("Size: %s / %s bytes" % (c.size(), c.max_bytes))
+
+@cache.command()
+def clear():
+    from . import capabilities
+    from . import connection
+    connection.tile_cache.clear()
+    capabilities.clear()
+
+@main.command()
+@click.option('--output', default="benchmark.json", help='JSON file to write the results to')
+@click.option('--latency', default=0.05, type=float, help='Seconds per tile request of the mock server')
+@click.option('--repeat', default=3, type=int)
+@click.option('--only', default=None, help='Only run scenarios whose name contains this')
+def benchmark(output, latency, repeat, only):
+    from . import benchmark
+    results = benchmark.run(repeat=repeat, latency=latency, only=only)
+    benchmark.write(results, output)
+
+def read_aoi(aoi, crs):
+    """An area of interest given on the command line: a vector file, or
+    a bounding box xmin,ymin,xmax,ymax in crs"""
+    import geopandas as gpd
+    import shapely.geometry
+    if os.path.exists(aoi):
+        return gpd.read_file(aoi)
+    try:
+        bounds = [float(value) for value in aoi.split(",")]
+    except ValueError:
+        bounds = []
+    if len(bounds) != 4:
+        raise click.BadParameter("neither a file nor xmin,ymin,xmax,ymax: %s" % aoi, param_hint="AOI")
+    return gpd.GeoDataFrame(geometry=[shapely.geometry.box(*bounds)], crs=crs)
+
+def progress(event):
+    "Prints download progress to stderr, keeping stdout clean for pipelines"
+    if event["event"] == "tile":
+        click.echo("\rDownloaded %(done)s/%(total)s tiles" % event, err=True, nl=event["done"] == event["total"])
+
+@main.command()
+@click.argument('aoi', type=str)
+@click.argument('source', type=str)
+@click.argument('res', type=float)
+@click.argument('out', type=str)
+@click.option('--crs', default="EPSG:4326", help='Crs of AOI when given as a bounding box')
+@click.option('--buffer', default=None, type=float, help='Buffer around AOI, in the units of the source crs')
+@click.option('--workers', default=None, type=int, help='Number of tiles to download in parallel')
+@click.option('--snap', is_flag=True, default=False, help='Snap RES to the native grid of the source')
+@click.option('--resume', is_flag=True, default=False, help='Pick up an interrupted download to OUT')
+@click.option('--no-cache', is_flag=True, default=False, help='Do not use the tile cache')
+@click.option('--proxy', default=None, help='URL of a terrainy proxy to fetch tiles through (default $TERRAINY_PROXY)')
+@click.option('--quiet', is_flag=True, default=False, help='Do not report progress')
+def download(aoi, source, res, out, crs, buffer, workers, snap, resume, no_cache, proxy, quiet):
+    """Downloads SOURCE at resolution RES (in the units of its crs)
+    for AOI, a vector file or a bounding box xmin,ymin,xmax,ymax,
+    streaming the tiles straight to a GeoTIFF at OUT"""
+    from . import connection
+    from . import sources
+    if quiet:
+        quiet_logging()
+    gdf = read_aoi(aoi, crs)
+    con = connection.connect(cache=not no_cache, proxy=proxy, **sources.get(source))
+    res = con.download(gdf, res, workers=workers, out_path=out, buffer=buffer, snap=snap, resume=resume,
+                       callback=None if quiet else progress)
+    if not quiet:
+        summary = res["stats"]
+        click.echo("Wrote %s: %s tiles, %s bytes in %.1fs" % (
+            out, summary["tiles"], summary["bytes"], sum(summary["stages"].values())), err=True)
+
+@main.command()
+@click.argument('aoi', type=str)
+@click.argument('source', type=str)
+@click.argument('res', type=float)
+@click.argument('out', type=str)
+@click.option('--max-res', default=None, type=float, help='Coarsest resolution to keep overviews for')
+@click.option('--title', default=None, help='Title of the mirror in the source catalog (default "SOURCE mirror")')
+@click.option('--no-register', is_flag=True, default=False, help='Do not add the mirror to the source catalog')
+@click.option('--crs', default="EPSG:4326", help='Crs of AOI when given as a bounding box')
+@click.option('--buffer', default=None, type=float, help='Buffer around AOI, in the units of the source crs')
+@click.option('--workers', default=None, type=int, help='Number of tiles to download in parallel')
+@click.option('--resume', is_flag=True, default=False, help='Pick up an interrupted prefetch to OUT')
+@click.option('--quiet', is_flag=True, default=False, help='Do not report progress')
+def prefetch(aoi, source, res, out, max_res, title, no_register, crs, buffer, workers, resume, quiet):
+    """Mirrors SOURCE at resolution RES for AOI into a Cloud Optimized
+    GeoTIFF at OUT, with overviews up to --max-res, and adds it to the
+    source catalog as a local "file" source"""
+    from . import mirror
+    if quiet:
+        quiet_logging()
+    gdf = read_aoi(aoi, crs)
+    res = mirror.prefetch(source, gdf, res, out, max_res=max_res, workers=workers, buffer=buffer, resume=resume,
+                          callback=None if quiet else progress)
+    if not no_register:
+        title = title or "%s mirror" % source
+        mirror.register(title, out, layer=source)
+        if not quiet:
+            click.echo("Added %s to the source catalog" % title, err=True)
+
+@main.command()
+@click.option('--host', default="127.0.0.1", help='Address to listen on')
+@click.option('--port', default=8765, type=int, help='Port to listen on')
+@click.option('--concurrency', default=None, type=int, help='Concurrent requests to each server, for all clients together')
+@click.option('--no-cache', is_flag=True, default=False, help='Do not use the tile cache')
+def serve(host, port, concurrency, no_cache):
+    """Serves the tiles of the sources in the catalog to other terrainy
+    processes (see --proxy), fetching each tile from its server once"""
+    from . import proxy
+    proxy.Proxy(cache=not no_cache, concurrency=concurrency, host=host, port=port).serve_forever()
@@ -0,0 +1,260 @@
+import concurrent.futures
+import threading
+import time
+import numpy as np
+import geopandas as gpd
+import shapely.geometry
+import shapely.prepared
+from rasterio.crs import CRS
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds, Resampling
+from . import connection
+from . import instrument
+from . import mosaic
+
+
+class Source(object):
+    """One of the sources of a composite download: a connection, and
+    its coverage (from the source catalog) in the crs of the composite
+    raster"""
+
+    def __init__(self, title, con, coverage, crs):
+        self.title = title
+        self.connection = con
+        self.same_crs = CRS.from_user_input(con.get_crs()) == CRS.from_user_input(crs)
+        if coverage is None or coverage.is_empty:
+            # Unknown coverage, assume the source covers everything
+            self.coverage = None
+        else:
+            self.coverage = shapely.prepared.prep(gpd.GeoSeries([coverage], crs=4326).to_crs(crs).iloc[0])
+
+    def intersects(self, polygon):
+        return self.coverage is None or self.coverage.intersects(polygon)
+
+    def fetch(self, con, bounds, tif_res, size, crs, resampling):
+        """Fetches the data of this source covering bounds (in crs) as a
+        tile of size (width, height) pixels on the composite grid.
+
+        Tiles of sources in another crs are fetched in their own crs
+        at about the same resolution, and reprojected onto the grid.
+
+        Returns (array, nodata, valid, nbytes, source) where valid is a
+        boolean (height, width) mask of pixels with data."""
+        width, height = size
+        if self.same_crs:
+            src_bounds = bounds
+            src_res = tif_res
+            src_size = size
+        else:
+            src_bounds = transform_bounds(crs, con.get_crs(), *bounds, densify_pts=21)
+            src_res = min((src_bounds[2] - src_bounds[0]) / width, (src_bounds[3] - src_bounds[1]) / height)
+            # A margin, so that resampling at the edges has neighbours
+            margin = 2 * src_res
+            src_bounds = (src_bounds[0] - margin, src_bounds[1] - margin,
+                          src_bounds[2] + margin, src_bounds[3] + margin)
+            src_size = (int(np.ceil((src_bounds[2] - src_bounds[0]) / src_res)),
+                        int(np.ceil((src_bounds[3] - src_bounds[1]) / src_res)))
+
+        array, nodata, nbytes, source = self.read(con, src_bounds, src_res, src_size)
+
+        if self.same_crs:
+            valid = np.ones((height, width), dtype=bool)
+        else:
+            src_transform = from_bounds(*src_bounds, *src_size)
+            dst_transform = from_bounds(*bounds, width, height)
+            dst = np.zeros((array.shape[0], height, width), dtype=array.dtype)
+            if nodata is not None:
+                dst[:] = nodata
+            reproject(array, dst, src_transform=src_transform, src_crs=con.get_crs(), src_nodata=nodata,
+                      dst_transform=dst_transform, dst_crs=crs, dst_nodata=nodata, resampling=resampling)
+            footprint = np.zeros((height, width), dtype="uint8")
+            reproject(np.ones(array.shape[1:], dtype="uint8"), footprint,
+                      src_transform=src_transform, src_crs=con.get_crs(),
+                      dst_transform=dst_transform, dst_crs=crs, resampling=Resampling.nearest)
+            array = dst
+            valid = footprint > 0
+        if nodata is not None:
+            valid &= ~mosaic.nodata_mask(array, nodata).all(axis=0)
+        return array, nodata, valid, nbytes, source
+
+    def read(self, con, bounds, tif_res, size):
+        """Reads size (width, height) pixels covering bounds from the
+        source, in as many tiles as its tile size (see
+        connection.Connection.get_tile_size()) requires.
+
+        Returns (array, nodata, nbytes, source)."""
+        width, height = size
+        max_width, max_height = con.get_tile_size()
+        xres = (bounds[2] - bounds[0]) / width
+        yres = (bounds[3] - bounds[1]) / height
+        array = None
+        nodata = None
+        nbytes = 0
+        sources = []
+        for row_off in range(0, height, max_height):
+            for col_off in range(0, width, max_width):
+                part_width, part_height = min(max_width, width - col_off), min(max_height, height - row_off)
+                if (part_width, part_height) == size:
+                    part_bounds, part_res = bounds, tif_res
+                else:
+                    part_bounds = (bounds[0] + col_off * xres, bounds[3] - (row_off + part_height) * yres,
+                                   bounds[0] + (col_off + part_width) * xres, bounds[3] - row_off * yres)
+                    part_res = xres
+                data, source = con.fetch_tile_from(part_bounds, part_res, (part_width, part_height))
+                with connection.open_data(data) as dataset:
+                    part = dataset.read(out_shape=(dataset.count, part_height, part_width))
+                    nodata = dataset.nodata
+                if array is None:
+                    array = np.empty((part.shape[0], height, width), dtype=part.dtype)
+                array[:, row_off:row_off + part_height, col_off:col_off + part_width] = part
+                nbytes += connection.tile_nbytes(data)
+                sources.append(source)
+        return array, nodata, nbytes, "server" if "server" in sources else sources[0]
+
+
+def download(catalog, gdf, tif_res, cache=True, workers=None, out_path=None, buffer=None, dtype=None,
+             resampling=None, callback=None):
+    """Downloads a raster covering gdf at tif_res from several sources
+    in one pass. catalog holds the sources in priority order (rows of
+    the source catalog, see sources.catalog(), indexed by title).
+
+    The raster is laid out on the tile grid of the first source, in
+    its crs. Every tile is fetched from the first source whose
+    coverage (the catalog geometry) intersects it. Pixels without
+    data, e.g. where a tile straddles the edge of that coverage, are
+    filled from the next source covering the tile, and so on, so that
+    each tile is only fetched from as many sources as needed. Tiles
+    of sources in another crs are reprojected onto the grid using
+    resampling (default nearest). Sources whose tile size is smaller
+    than that of the first source are fetched in several pieces, see
+    Source.read().
+
+    Returns a dictionary like connection.Connection.download(), with
+    the number of tiles each source contributed to as "sources".
+    Pixels no source has data for are set to nodata."""
+    if workers is None:
+        workers = connection.download_workers
+    if resampling is None:
+        resampling = Resampling.nearest
+    stats = instrument.Stats(callback)
+
+    with stats.stage("plan"):
+        primary = connection.connect(cache=cache, **catalog.iloc[0])
+        crs = primary.get_crs()
+        sources = [Source(title, primary if idx == 0 else connection.connect(cache=cache, **row),
+                          row.geometry, crs)
+                   for idx, (title, row) in enumerate(catalog.iterrows())]
+        bands = primary.bands
+        for source in sources:
+            if source.connection.bands != bands:
+                raise ValueError("Source %s has %s bands, %s has %s" % (
+                    source.title, source.connection.bands, sources[0].title, bands))
+
+        gdf = gdf.to_crs(crs)
+        grid = primary.get_grid(tif_res)
+        tile_width, tile_length = grid["tile_size"]
+        plan = primary.plan_tiles(primary.get_aoi(gdf, buffer), grid)
+        tiles = []
+        skipped = plan["skipped"]
+        for tile in plan["tiles"]:
+            polygon = shapely.geometry.box(*tile.bounds)
+            candidates = [idx for idx, source in enumerate(sources) if source.intersects(polygon)]
+            if candidates:
+                tiles.append((tile, candidates))
+            else:
+                skipped += 1
+    if skipped:
+        instrument.logger.info("Skipping %s of %s blocks outside the area of interest or the sources",
+                               skipped, plan["nr_cols"] * plan["nr_rows"])
+    stats.total = len(tiles)
+
+    local = threading.local()
+    lock = threading.Lock()
+    counts = {source.title: 0 for source in sources}
+    fmt = {"dtype": dtype, "nodata": None}
+
+    def composite_block(tile, candidates):
+        if workers > 1:
+            if not hasattr(local, "connections"):
+                local.connections = [source.connection.clone() for source in sources]
+            connections = local.connections
+        else:
+            connections = [source.connection for source in sources]
+
+        start = time.perf_counter()
+        result = None
+        filled = None
+        nbytes = 0
+        from_server = False
+        used = []
+        for idx in candidates:
+            array, tile_nodata, valid, size, source = sources[idx].fetch(
+                connections[idx], tile.bounds, tif_res, (tile.width, tile.height), crs, resampling)
+            nbytes += size
+            from_server = from_server or source == "server"
+            with lock:
+                # The first tile decides the data type and nodata value of the mosaic
+                if fmt["dtype"] is None:
+                    fmt["dtype"] = array.dtype
+                if fmt["nodata"] is None:
+                    fmt["nodata"] = tile_nodata
+                    if tile_nodata is None or np.dtype(fmt["dtype"]) != array.dtype:
+                        fmt["nodata"] = mosaic.default_nodata(fmt["dtype"])
+            if result is None:
+                result = np.full((bands, tile.height, tile.width), fmt["nodata"], dtype=fmt["dtype"])
+                filled = np.zeros((tile.height, tile.width), dtype=bool)
+            take = valid & ~filled
+            if take.any():
+                array = mosaic.convert(array, fmt["dtype"], tile_nodata, fmt["nodata"])
+                result[:, take] = array[:, take]
+                filled |= take
+                used.append(sources[idx].title)
+            if filled.all():
+                break
+        fetched = time.perf_counter()
+        return result, used, nbytes, "server" if from_server else "cache", fetched - start
+
+    def write_block(tile, block):
+        result, used, nbytes, source, fetch_seconds = block
+        start = time.perf_counter()
+        out.write(result, tile.row_off, tile.col_off)
+        with lock:
+            for title in used:
+                counts[title] += 1
+        stats.tile((tile.x_idx, tile.y_idx), nbytes, source, fetch_seconds, 0.0, time.perf_counter() - start)
+
+    download_start = time.perf_counter()
+    # The first tile decides the data type, see composite_block()
+    first = composite_block(*tiles[0]) if tiles else None
+    if fmt["dtype"] is None:
+        fmt["dtype"] = primary.dtype
+    if fmt["nodata"] is None:
+        fmt["nodata"] = mosaic.default_nodata(fmt["dtype"])
+
+    out = primary.make_mosaic(out_path, bands, plan["height"], plan["width"],
+                              fmt["dtype"], plan["transform"], tile_size=(tile_width, tile_length),
+                              tile_offset=plan["tile_offset"], nodata=fmt["nodata"])
+    try:
+        if first is not None:
+            write_block(tiles[0][0], first)
+            first = None
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+            futures = [executor.submit(lambda tile: write_block(tile[0], composite_block(*tile)), tile)
+                       for tile in tiles[1:]]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        out.close()
+        stats.record("download", time.perf_counter() - download_start)
+
+    res = out.result()
+    data = dict(primary.kw)
+    data["crs_orig"] = crs
+    res.update({"data": data, "gdf": gdf, "tiles_skipped": skipped, "resolution": grid["res"],
+                "sources": counts, "stats": stats.summary()})
+    return res
@@ -1,117 +1,885 @@
 import rasterio
-import rasterio.mask
+import rasterio.features
+import rasterio.errors
 from rasterio.transform import Affine
-import rasterio
 from rasterio import MemoryFile
-from rasterio.plot import show
-import rasterio.mask
-from rasterio.transform import Affine
-import rasterio.rio.clip
-from rasterio.crs import CRS
 import geopandas as gpd
 import time
 import numpy as np
-from shapely.geometry import Polygon
-from owslib.wcs import WebCoverageService
-from owslib.wms import WebMapService
-import pkg_resources
+import shapely.geometry
+import shapely.ops
+import shapely.prepared
 import importlib.metadata
 import shapely
 import json
 import contextlib
 import os
+import collections
+import copy
+import functools
+import threading
+import concurrent.futures
+import urllib.parse
+import random
+import requests
+from . import cache as tilecache
+from . import instrument
+from . import job as jobs
+from . import mosaic
 
-# Grid sizing
+# Grid sizing. Default tile size, for sources without a tile size of
+# their own, see Connection.get_tile_size()
 tile_pixel_length = 1024
 tile_pixel_width = 1024
 
+# Tile sizes tried by Connection.tune_tile_size(). A larger tile size
+# is only chosen if its throughput is more than tune_threshold times
+# better.
+tune_tile_sizes = (512, 1024, 2048, 4096)
+tune_threshold = 1.1
+tune_repeat = 2
+
 cachedir = os.path.expanduser("~/.cache/terrainy")
 
+# Shared by all connections unless a connection is given its own cache
+tile_cache = tilecache.TileCache(os.path.join(cachedir, "tiles"))
+
+# Coverage detection, see Connection.get_shape(). A block counts as
+# covered when this fraction of its pixels have data.
+coverage_probe_blocks = 4
+coverage_probe_depth = 4
+coverage_probe_size = 64
+coverage_threshold = 0.95
+
+# Default number of tiles to download in parallel
+download_workers = 4
+
+# Number of threads decoding downloaded tiles, so that decoding
+# overlaps with the requests in flight (default one per core)
+decode_workers = None
+
+# Tile requests failing with a transient error (see transient()) are
+# retried this many times, with exponential backoff starting at
+# tile_backoff seconds. HTTP status codes that are worth retrying:
+tile_retries = 3
+tile_backoff = 1
+retry_statuses = (429, 500, 502, 503, 504)
+
+# Maximum number of concurrent requests to any one server, shared by
+# all connections and downloads in this process. Change it with
+# set_host_concurrency(), which also applies it to servers already
+# requested from.
+host_concurrency = 4
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+# URL of a terrainy proxy (see proxy.py) to request tiles through,
+# unless a connection is given a proxy of its own
+default_proxy = os.environ.get("TERRAINY_PROXY")
+proxy_timeout = 300
+
+
+def host_semaphore(host):
+    "Returns the semaphore limiting the number of concurrent requests to host"
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(host_concurrency)
+        return host_semaphores[host]
+
+
+def set_host_concurrency(concurrency):
+    """Sets the maximum number of concurrent requests to any one server,
+    for the whole process. Requests in flight finish under the old
+    limit."""
+    global host_concurrency
+    with host_semaphores_lock:
+        host_concurrency = concurrency
+        host_semaphores.clear()
+
+
+class NotATile(Exception):
+    "A server answered a tile request with something else, e.g. an error page"
+
+
+def transient(e):
+    """Whether a failed tile request might succeed if retried: timeouts,
+    connection errors, 5xx/429 responses and responses that are not
+    tiles. Anything else (4xx responses, OGC service exceptions,
+    unsupported requests) fails the same way every time."""
+    if isinstance(e, (requests.Timeout, requests.ConnectionError, NotATile,
+                      requests.exceptions.ChunkedEncodingError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code in retry_statuses
+    return False
+
+
+def read_response(response):
+    """Returns the bytes of a tile response (owslib response object or
+    bytes), or an ArrayTile as is.
+
+    owslib only raises for some HTTP error statuses, and passes others
+    (e.g. 429) on as if they were tiles. Raises requests.HTTPError for
+    those, and NotATile for text, XML and JSON bodies."""
+    if isinstance(response, ArrayTile) or not hasattr(response, "read"):
+        return response
+    http = getattr(response, "_response", None)
+    if isinstance(http, requests.Response):
+        http.raise_for_status()
+        content_type = http.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type.startswith("text/") or "xml" in content_type or "json" in content_type:
+            raise NotATile("Expected a tile, got %s: %r" % (content_type, http.content[:200]))
+    return response.read()
+
+
+class ArrayTile(object):
+    """The pixels of a tile that is already in memory, e.g. read from a
+    local file (see connection_file.py), as download_tile() may return
+    instead of encoded bytes. Has the part of the rasterio dataset
+    interface used to decode tiles, see open_data(). read() returns
+    the array itself, not a copy."""
+
+    def __init__(self, array, nodata=None, crs=None, transform=None):
+        self.array = array
+        self.nodata = nodata
+        self.crs = crs
+        self.transform = transform
+        self.count, self.height, self.width = array.shape
+        self.dtypes = [array.dtype.name] * self.count
+        self.nbytes = array.nbytes
+
+    def encode(self):
+        "Returns the tile as GeoTIFF bytes, e.g. to serve it through the proxy"
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=self.width, height=self.height, count=self.count,
+                              dtype=self.array.dtype, crs=self.crs, nodata=self.nodata,
+                              transform=self.transform) as dataset:
+                dataset.write(self.array)
+            return memfile.read()
+
+    def read(self, out=None, out_shape=None):
+        if out_shape is not None and tuple(out_shape) != self.array.shape:
+            raise ValueError("Tile is %s, not %s" % (self.array.shape, tuple(out_shape)))
+        if out is None:
+            return self.array
+        out[...] = self.array
+        return out
+
+
+def tile_nbytes(data):
+    "Size in bytes of the data of a tile (bytes or an ArrayTile)"
+    if isinstance(data, ArrayTile):
+        return data.nbytes
+    return len(data)
+
+
+@contextlib.contextmanager
+def open_data(data):
+    """Opens the data of a tile, bytes in any format GDAL reads or an
+    ArrayTile, as a rasterio dataset"""
+    if isinstance(data, ArrayTile):
+        yield data
+        return
+    with MemoryFile(data) as memfile:
+        with memfile.open() as dataset:
+            yield dataset
+
+
+def check_tile(data):
+    """Raises NotATile unless the data of a tile opens the way download()
+    decodes it, so that e.g. an error page is never cached as a tile"""
+    try:
+        with open_data(data):
+            pass
+    except (rasterio.errors.RasterioError, ValueError) as e:
+        raise NotATile("Response does not open as a raster: %s" % e) from e
+
+
+# A tile of a download plan, see Connection.plan_tiles(). x_idx, y_idx
+# is the column and row of the tile in the plan, bounds what to
+# download, and row_off, col_off, width, height the pixels of the
+# mosaic it covers.
+Tile = collections.namedtuple("Tile", ["x_idx", "y_idx", "bounds", "row_off", "col_off", "width", "height"])
 
-# fixme: Intergrate caching
 
 class Connection(object):
-    def __init__(self, **kw):
+    file_format = None
+
+    def __init__(self, cache=True, proxy=None, **kw):
+        """cache is either a TileCache instance, True to use the
+        shared tile_cache, or None/False to disable caching.
+
+        proxy is the URL of a terrainy proxy (see proxy.py) to request
+        tiles through instead of from the server, defaulting to
+        default_proxy (the TERRAINY_PROXY environment variable), or
+        False to always go to the server."""
         self.kw = kw
+        if cache is True:
+            cache = tile_cache
+        self.cache = cache or None
+        if proxy is None:
+            proxy = default_proxy
+        self.proxy = proxy or None
+        # Set by download_many(), see cache.TileMemo
+        self.memo = None
+
+    def probe_block(self, bounds, size, empty):
+        """Fetches a small tile of the map, and returns a boolean mask of
+        the pixels that have data, i.e. differ from the same pixel of
+        empty, a tile of the same resolution and size from outside the
+        map (see empty_tile())"""
+        width, height = size
+        res = (bounds[2] - bounds[0]) / width
+        with self.open_tile(bounds, res, size) as dataset:
+            data_array = dataset.read(out_shape=(dataset.count, height, width))
+        return (data_array != empty).max(axis=0)
+
+    def empty_tile(self, bbox, block_w, block_h, size):
+        """Fetches a tile of size pixels covering block_w x block_h just
+        left of bbox, the bounds of the map, to compare the blocks
+        probed at that resolution with"""
+        width, height = size
+        bounds = (bbox[0] - block_w, bbox[3] - block_h, bbox[0], bbox[3])
+        with self.open_tile(bounds, block_w / width, size) as dataset:
+            return dataset.read(out_shape=(dataset.count, height, width))
 
-    def get_shape(self):
+    def get_shape(self, workers=None):
+        """Returns the coverage of the map as a GeoDataFrame with a
+        single geometry.
+
+        The bounds of the map are probed with a coarse grid of
+        coverage_probe_blocks x coverage_probe_blocks small tiles.
+        Blocks with data in at least coverage_threshold of their
+        pixels count as covered. Blocks that are partly covered are
+        split in four and probed again, down to coverage_probe_depth
+        levels or until the probe pixels are as small as the native
+        pixels of the map, so that only the edges of the coverage are
+        probed at the finest resolution. Blocks of each level are
+        fetched in parallel by workers threads.
+
+        The coverage is simplified to within two of the finest probe
+        pixels, and holes in it are filled, so that it stays small
+        in the source catalog."""
+        if workers is None:
+            workers = download_workers
         bbox = self.get_bounds()
-        empty_bbox = list(bbox)
-        w = empty_bbox[2] - empty_bbox[0]
-        empty_bbox[0] -= w
-        empty_bbox[2] -= w
-        with self.open_tile(empty_bbox,
-                            (empty_bbox[2] - empty_bbox[0]) / tile_pixel_width,
-                            (tile_pixel_width, tile_pixel_length)) as dataset:
-            empty_data_array = dataset.read()
-
-        with self.open_tile(bbox,
-                            (bbox[2] - bbox[0]) / tile_pixel_width,
-                            (tile_pixel_width, tile_pixel_length)) as dataset:
-            data_array = dataset.read()
-
-        xres = (bbox[2] - bbox[0]) / tile_pixel_width
-        yres = (bbox[3] - bbox[1]) / tile_pixel_length
-        transform = rasterio.transform.Affine.translation(bbox[0], bbox[3]) * rasterio.transform.Affine.scale(xres,
-                                                                                                              -yres)
-        geometry = [shapely.geometry.shape(shp)
-                    for shp, val in
-                    rasterio.features.shapes((data_array != empty_data_array).max(axis=0).astype("int16"),
-                                             transform=transform)
-                    if val > 0]
+        block_w = (bbox[2] - bbox[0]) / coverage_probe_blocks
+        block_h = (bbox[3] - bbox[1]) / coverage_probe_blocks
+        size = (coverage_probe_size, max(1, int(round(coverage_probe_size * block_h / block_w))))
+        native = self.get_native_grid()
+        min_block_w = coverage_probe_size * native[2] if native is not None else 0
+
+        blocks = [(bbox[0] + x * block_w, bbox[3] - (y + 1) * block_h,
+                   bbox[0] + (x + 1) * block_w, bbox[3] - y * block_h)
+                  for x in range(coverage_probe_blocks)
+                  for y in range(coverage_probe_blocks)]
+        geometry = []
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+            for depth in range(coverage_probe_depth + 1):
+                if not blocks:
+                    break
+                # All blocks of a level have the same size, and are
+                # compared with one empty tile at their resolution
+                level_w, level_h = blocks[0][2] - blocks[0][0], blocks[0][3] - blocks[0][1]
+                empty = self.empty_tile(bbox, level_w, level_h, size)
+                masks = executor.map(lambda bounds: self.probe_block(bounds, size, empty), blocks)
+                pixel_w = level_w / size[0]
+                refine = depth < coverage_probe_depth and level_w >= 2 * min_block_w
+                edge_blocks = []
+                for bounds, mask in zip(blocks, masks):
+                    covered = mask.mean()
+                    if covered >= coverage_threshold:
+                        geometry.append(shapely.geometry.box(*bounds))
+                    elif not covered:
+                        continue
+                    elif refine:
+                        xmid = (bounds[0] + bounds[2]) / 2
+                        ymid = (bounds[1] + bounds[3]) / 2
+                        edge_blocks.extend([(bounds[0], ymid, xmid, bounds[3]),
+                                            (xmid, ymid, bounds[2], bounds[3]),
+                                            (bounds[0], bounds[1], xmid, ymid),
+                                            (xmid, bounds[1], bounds[2], ymid)])
+                    else:
+                        transform = rasterio.transform.from_bounds(*bounds, mask.shape[1], mask.shape[0])
+                        geometry.extend(shapely.geometry.shape(shp)
+                                        for shp, val in
+                                        rasterio.features.shapes(mask.astype("uint8"), mask=mask,
+                                                                 transform=transform)
+                                        if val > 0)
+                instrument.logger.info("Coverage probe level %s: %s blocks, %s on the edge",
+                                       depth, len(blocks), len(edge_blocks))
+                blocks = edge_blocks
+
         if not len(geometry):
             raise ValueError("Map has only empty tiles!")
 
+        coverage = shapely.ops.unary_union(geometry).simplify(2 * pixel_w)
+        polygons = getattr(coverage, "geoms", [coverage])
+        coverage = shapely.ops.unary_union([shapely.geometry.Polygon(polygon.exterior)
+                                            for polygon in polygons if not polygon.is_empty])
         return gpd.GeoDataFrame(
-            geometry=[gpd.GeoDataFrame(geometry=geometry).geometry.unary_union]
+            geometry=[coverage]
         ).set_crs(self.get_crs())
 
+    def clone(self):
+        """Returns a copy of this connection for use by a worker thread.
+        Subclasses override this to give the copy its own network
+        session."""
+        return copy.copy(self)
+
+    def get_host(self):
+        "Server hostname, used to limit the number of concurrent requests"
+        if self.proxy is not None:
+            return urllib.parse.urlsplit(self.proxy).netloc
+        return urllib.parse.urlsplit(self.kw.get("connection_args", {}).get("url", "")).netloc
+
+    def tile_key(self, bounds, tif_res, size):
+        "Parameters uniquely identifying a tile, used as the tile cache key"
+        return {"connection_type": self.kw.get("connection_type"),
+                "connection_args": self.kw.get("connection_args"),
+                "layer": self.kw.get("layer"),
+                "crs": self.get_crs(),
+                "bounds": [float(b) for b in bounds],
+                "resolution": float(tif_res),
+                "size": [int(s) for s in size],
+                "format": self.tile_format()}
+
+    def tile_format(self):
+        "The tile format recorded in the tile cache key"
+        return self.file_format
+
+    def fetch_tile(self, bounds, tif_res, size):
+        """Returns the raw bytes (or ArrayTile) of a tile, from the tile
+        memo or cache if possible"""
+        return self.fetch_tile_from(bounds, tif_res, size)[0]
+
+    def fetch_tile_from(self, bounds, tif_res, size):
+        """Returns (bytes, source) for a tile, where source is "memo",
+        "cache" or "server", depending on where the tile was found"""
+        if self.cache is None and self.memo is None:
+            return self.request_tile(bounds, tif_res, size), "server"
+        key = tilecache.key(**self.tile_key(bounds, tif_res, size))
+        if self.memo is not None:
+            data = self.memo.get(key)
+            if data is not None:
+                return data, "memo"
+        data = None
+        source = "cache"
+        if self.cache is not None:
+            data = self.cache.get(key)
+        if data is None:
+            source = "server"
+            data = self.request_tile(bounds, tif_res, size)
+            if self.cache is not None:
+                self.cache.put(key, data)
+        if self.memo is not None:
+            self.memo.put(key, data)
+        return data, source
+
+    def request_tile(self, bounds, tif_res, size):
+        """Downloads the bytes of a tile, respecting the per host
+        concurrency limit, and checks that they open as a raster (see
+        check_tile()) before they are cached. Requests failing with a
+        transient error are retried tile_retries times with exponential
+        backoff, others raise at once."""
+        for attempt in range(tile_retries + 1):
+            try:
+                with host_semaphore(self.get_host()):
+                    if self.proxy is not None:
+                        data = self.proxy_tile(bounds, tif_res, size)
+                    else:
+                        data = read_response(self.download_tile(bounds, tif_res, size))
+                check_tile(data)
+                return data
+            except Exception as e:
+                if attempt == tile_retries or not transient(e):
+                    raise
+                delay = tile_backoff * 2 ** attempt * (1 + random.random())
+                instrument.logger.warning("Tile request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+
+    def proxy_tile(self, bounds, tif_res, size):
+        """Downloads the bytes of a tile through the proxy, which fetches
+        it from the server once for all its clients"""
+        source = {key: self.kw.get(key) for key in ("connection_type", "connection_args", "layer")}
+        response = requests.get(self.proxy.rstrip("/") + "/tile",
+                                params={"source": json.dumps(source, sort_keys=True, default=str),
+                                        "bbox": ",".join(repr(float(b)) for b in bounds),
+                                        "res": repr(float(tif_res)),
+                                        "width": int(size[0]),
+                                        "height": int(size[1])},
+                                timeout=proxy_timeout)
+        response.raise_for_status()
+        return response.content
+
     @contextlib.contextmanager
-    def open_tile(self, *arg, **kw):
-        response = self.download_tile(*arg, **kw)
-        with MemoryFile(response) as memfile:
-            with memfile.open() as dataset:
-                yield dataset
-
-    def download(self, gdf, tif_res):
-        # Convert data back to crs of map
-        gdf = gdf.to_crs(self.get_crs())
-        xmin, ymin, xmax, ymax = gdf.total_bounds
+    def open_tile(self, bounds, tif_res, size):
+        with open_data(self.fetch_tile(bounds, tif_res, size)) as dataset:
+            yield dataset
+
+    def make_mosaic(self, out_path, bands, height, width, dtype, transform, **kw):
+        """Returns an ArrayMosaic, or a FileMosaic if out_path is given.
+        kw (tile_size, nodata, scale, offset) is passed on to the mosaic."""
+        if out_path is None:
+            return mosaic.ArrayMosaic(bands, height, width, dtype, transform, self.get_crs(), **kw)
+        return mosaic.FileMosaic(out_path, bands, height, width, dtype, transform, self.get_crs(), **kw)
+
+    def get_aoi(self, gdf, buffer=None):
+        "Returns the union of the geometries of gdf (in the map crs), buffered by buffer"
+        aoi = shapely.ops.unary_union(list(gdf.geometry))
+        if buffer is not None:
+            aoi = aoi.buffer(buffer)
+        return aoi
+
+    def get_max_tile_size(self):
+        "Returns (width, height) of the largest tile the server accepts, or None if it does not say"
+        return None
+
+    def get_tile_size(self):
+        """Returns (width, height) of the tiles to download: the tile size
+        remembered for the source in the catalog (see
+        sources.tune_tile_size()), or tile_pixel_width x
+        tile_pixel_length, limited to what the server accepts."""
+        size = self.kw.get("tile_size")
+        # Missing values in the catalog are NaN
+        if size is not None and size == size:
+            width = height = int(size)
+        else:
+            width, height = tile_pixel_width, tile_pixel_length
+        max_size = self.get_max_tile_size()
+        if max_size is not None:
+            width, height = min(width, max_size[0]), min(height, max_size[1])
+        return width, height
+
+    def tune_tile_size(self, center, tif_res, sizes=None):
+        """Measures the throughput (pixels per second) of square tiles of
+        increasing sizes (default tune_tile_sizes) around center (x, y
+        in the map crs) at tif_res, and returns the smallest size whose
+        throughput is within tune_threshold of the best one.
+
+        Sizes beyond the advertised maximum of the server (see
+        get_max_tile_size()) are not tried, and the first size the
+        server fails to deliver ends the search."""
+        if sizes is None:
+            sizes = tune_tile_sizes
+        max_size = self.get_max_tile_size()
+        throughput = {}
+        for size in sorted(sizes):
+            if max_size is not None and (size > max_size[0] or size > max_size[1]):
+                break
+            half = size * tif_res / 2
+            bounds = (center[0] - half, center[1] - half, center[0] + half, center[1] + half)
+            try:
+                seconds = []
+                for attempt in range(tune_repeat):
+                    start = time.perf_counter()
+                    with host_semaphore(self.get_host()):
+                        data = read_response(self.download_tile(bounds, tif_res, (size, size)))
+                    seconds.append(time.perf_counter() - start)
+                    with open_data(data) as dataset:
+                        # Some servers silently return smaller images than asked for
+                        if dataset.width < size or dataset.height < size:
+                            raise ValueError("got %sx%s pixels" % (dataset.width, dataset.height))
+            except Exception as e:
+                instrument.logger.info("Tile size %s failed: %s", size, e)
+                break
+            throughput[size] = size * size / min(seconds)
+            instrument.logger.info("Tile size %s: %.3fs, %.0f pixels/s", size, min(seconds), throughput[size])
+        if not throughput:
+            raise ValueError("Unable to download tiles of any size")
+        best = max(throughput.values())
+        return min(size for size, value in throughput.items() if value * tune_threshold >= best)
 
-        tile_m_length = tile_pixel_length * tif_res
-        tile_m_width = tile_pixel_width * tif_res
+    def get_native_grid(self):
+        """Returns (x, y, res) of the upper left corner and pixel size of
+        the native pixel grid of the map, or None if unknown"""
+        return None
 
-        width = (xmax - xmin) / tif_res
-        length = (ymax - ymin) / tif_res
+    def get_grid(self, tif_res, snap=False):
+        """Returns the pixel grid to download at for a requested
+        resolution, as a dictionary with:
 
-        nr_cols = int(np.ceil(width / tile_pixel_length))
-        nr_rows = int(np.ceil(length / tile_pixel_width))
+        res: resolution of the downloaded raster, and of the tiles
+             requested
+        origin: a point on the pixel grid, or None
+        tile_size: (width, height) of tiles in pixels, see
+                   get_tile_size()
 
-        array = np.zeros((self.bands, tile_pixel_length * nr_rows, tile_pixel_width * nr_cols), dtype=self.dtype)
+        Without snap, this is just tif_res. With snap, and if the
+        native grid of the map is known (see get_native_grid()), the
+        resolution is rounded to a whole multiple of the native
+        resolution and pixels are aligned with the native grid, so
+        that servers can deliver whole native pixels. Tiles are always
+        requested at the resolution of the raster, as fetching finer
+        tiles and decimating them locally would multiply the bytes
+        downloaded.
+        """
+        grid = {"res": tif_res,
+                "origin": None,
+                "tile_size": self.get_tile_size()}
+        native = self.get_native_grid() if snap else None
+        if native is None:
+            return grid
+        x, y, native_res = native
+        grid.update({"res": native_res * max(1, int(round(tif_res / native_res))),
+                     "origin": (x, y)})
+        instrument.logger.info("Snapping resolution %s to %s on the native grid (native %s)",
+                               tif_res, grid["res"], native_res)
+        return grid
 
+    def plan_tiles(self, aoi, grid, origin=None, trim=True):
+        """Lays out the tiles needed to cover aoi on a grid (see
+        get_grid()).
+
+        Tiles are laid out on a fixed, source wide grid, anchored at
+        origin (x, y of the upper left corner of a tile), which
+        defaults to the native grid origin of the map if known (see
+        get_grid()), or else to 0, 0 of the map crs. Tiles of the same
+        source, resolution and tile size thus have the same bounds in
+        every request, and can be shared (see the tile cache).
+
+        The mosaic covers exactly the pixels of the grid intersecting
+        the bounding box of aoi. With trim, tiles on the edge of the
+        mosaic are trimmed to the part within it, so that no pixels
+        outside it are downloaded. Without trim, whole tiles are
+        downloaded and cropped locally, which is better if the same
+        tiles are needed by other requests. Tiles not intersecting aoi
+        are skipped.
+
+        Returns a dictionary with the transform, width and height of
+        the mosaic, the number of tile columns and rows, the offset in
+        pixels of the mosaic within its first tile ("tile_offset", col,
+        row), the tiles as a list of Tile, and the number of skipped
+        tiles."""
+        tif_res = grid["res"]
+        tile_width, tile_length = grid["tile_size"]
+        if origin is None:
+            origin = grid["origin"] if grid["origin"] is not None else (0.0, 0.0)
+        xmin, ymin, xmax, ymax = aoi.bounds
+        prepared_aoi = shapely.prepared.prep(aoi)
+
+        # Pixel columns and rows of the mosaic, counted from origin.
+        # Allow for rounding errors in the bounds.
+        col_min = int(np.floor((xmin - origin[0]) / tif_res + 1e-6))
+        col_max = max(col_min + 1, int(np.ceil((xmax - origin[0]) / tif_res - 1e-6)))
+        row_min = int(np.floor((origin[1] - ymax) / tif_res + 1e-6))
+        row_max = max(row_min + 1, int(np.ceil((origin[1] - ymin) / tif_res - 1e-6)))
+
+        tile_col0, tile_row0 = col_min // tile_width, row_min // tile_length
+        nr_cols = (col_max - 1) // tile_width - tile_col0 + 1
+        nr_rows = (row_max - 1) // tile_length - tile_row0 + 1
+
+        tiles = []
+        skipped = 0
         for x_idx in range(nr_cols):
             for y_idx in range(nr_rows):
-                print('Working on block %s,%s of %s,%s' % (x_idx + 1, y_idx + 1, nr_cols, nr_rows))
+                c0 = (tile_col0 + x_idx) * tile_width
+                r0 = (tile_row0 + y_idx) * tile_length
+                c1, r1 = c0 + tile_width, r0 + tile_length
+                if trim:
+                    c0, c1 = max(c0, col_min), min(c1, col_max)
+                    r0, r1 = max(r0, row_min), min(r1, row_max)
+                # Computed from the origin in whole pixels, so that the
+                # same tile always gets identical bounds
+                bounds = (origin[0] + c0 * tif_res, origin[1] - r1 * tif_res,
+                          origin[0] + c1 * tif_res, origin[1] - r0 * tif_res)
+                if not prepared_aoi.intersects(shapely.geometry.box(*bounds)):
+                    skipped += 1
+                    continue
+                tiles.append(Tile(x_idx, y_idx, bounds, r0 - row_min, c0 - col_min, c1 - c0, r1 - r0))
 
-                x = xmin + x_idx * tile_m_width
-                y = ymax - y_idx * tile_m_length - tile_m_length
+        return {"transform": (Affine.translation(origin[0] + col_min * tif_res, origin[1] - row_min * tif_res)
+                              * Affine.scale(tif_res, -tif_res)),
+                "width": col_max - col_min,
+                "height": row_max - row_min,
+                "nr_cols": nr_cols,
+                "nr_rows": nr_rows,
+                "tile_offset": (col_min - tile_col0 * tile_width, row_min - tile_row0 * tile_length),
+                "tiles": tiles,
+                "skipped": skipped}
 
-                polygon = (Polygon(
-                    [(x, y), (x + tile_m_width, y), (x + tile_m_width, y + tile_m_length), (x, y + tile_m_length)]))
+    def download(self, gdf, tif_res, workers=None, out_path=None, buffer=None, origin=None, snap=False,
+                 dtype=None, scale=1, offset=0, resume=False, callback=None, trim=True):
+        """Downloads a raster covering gdf at tif_res resolution.
+        Tiles are downloaded by a pool of workers threads, each with
+        its own connection (see clone()). workers defaults to
+        download_workers.
 
-                with self.open_tile(polygon.bounds, tif_res, (tile_pixel_width, tile_pixel_length)) as dataset:
-                    data_array = dataset.read()
+        If out_path is given, tiles are written to a tiled GeoTIFF
+        there as they arrive instead of being kept in memory, and the
+        returned dictionary has a "path" instead of an "array".
 
-                    array[:, y_idx * tile_pixel_width:y_idx * tile_pixel_width + tile_pixel_width,
-                    x_idx * tile_pixel_length:x_idx * tile_pixel_length + tile_pixel_length] = data_array[:, :, :]
+        The raster covers exactly the bounding box of gdf, buffered
+        by buffer (in the units of the map crs), snapped outwards to
+        whole pixels. Only tiles intersecting the geometries are
+        downloaded. The rest of the bounding box is left empty, and
+        the number of skipped tiles is returned as "tiles_skipped".
 
-        transform = Affine.translation(xmin, ymax) * Affine.scale(tif_res, -tif_res)
-        return {"array": array, "transform": transform, "data": self.kw, "gdf": gdf}
+        Tiles are laid out on a fixed grid for the source, so that
+        tiles are shared between requests. origin overrides the
+        anchor of the grid, and trim=False downloads whole tiles on
+        the edges of the raster, see plan_tiles().
 
+        With snap, the resolution is snapped to the native pixel grid
+        of the map, see get_grid(). The resolution actually used is
+        returned as "resolution".
 
-def connect(**data):
-    connections = {entry.name: entry.load()
-                   for entry in importlib.metadata.entry_points()['terrainy.connection']}
-    if data["connection_type"] not in connections:
+        The mosaic has the data type and nodata value of the tiles the
+        server returns, unless dtype is given. Values are then stored
+        as (value - offset) / scale, e.g. dtype="int16", scale=0.1 for
+        decimeter precision heights up to 3276.7m in half the memory of
+        float32, or dtype="int32", scale=0.01 for centimeter precision
+        at any height. Values that do not fit in dtype raise a
+        ValueError rather than being clipped. The nodata value, scale and offset are returned as "nodata",
+        "scale" and "offset", and export() carries them through.
+        Missing and skipped tiles are not filled with any value, but
+        tracked per tile in "valid_tiles", a boolean array of tile rows
+        by tile columns.
+
+        With resume (and out_path), the download is run as a job: the
+        status of every tile is recorded in a manifest next to
+        out_path (see job.Job), and the file is flushed to disk
+        regularly. Tiles that still fail after retries are recorded as
+        failed while the rest of the tiles are downloaded, and an
+        error is raised at the end. Running the same download again
+        only fetches the tiles that are not done yet.
+
+        Progress, per tile timings and byte counts are reported as
+        events to callback and the "terrainy" logger, and summarized
+        in "stats", see instrument.Stats.
+        """
+        if workers is None:
+            workers = download_workers
+        stats = instrument.Stats(callback)
+
+        with stats.stage("plan"):
+            # Convert data back to crs of map
+            gdf = gdf.to_crs(self.get_crs())
+            grid = self.get_grid(tif_res, snap)
+            tile_width, tile_length = grid["tile_size"]
+            plan = self.plan_tiles(self.get_aoi(gdf, buffer), grid, origin, trim)
+        nr_cols, nr_rows = plan["nr_cols"], plan["nr_rows"]
+        tiles = plan["tiles"]
+        skipped = plan["skipped"]
+        if skipped:
+            instrument.logger.info("Skipping %s of %s blocks outside the area of interest", skipped, nr_cols * nr_rows)
+
+        if self.cache is not None:
+            cache_stats = self.cache.stats()
+
+        def fetch_block(con, tile):
+            "Fetches the data of a tile. Returns (data, info)"
+            start = time.perf_counter()
+            data, source = con.fetch_tile_from(tile.bounds, grid["res"], (tile.width, tile.height))
+            return data, {"bytes": tile_nbytes(data), "source": source, "fetch_seconds": time.perf_counter() - start}
+
+        def decode_block(tile, data, info, into=None):
+            """Decodes the data of a tile. If the tile can be stored as is,
+            it is decoded straight into the mosaic into, if given (see
+            mosaic.Mosaic.view()), without any intermediate array.
+            Returns (array, nodata, info), where array is None if the
+            tile was decoded into the mosaic."""
+            start = time.perf_counter()
+            with open_data(data) as dataset:
+                tile_nodata = dataset.nodata
+                view = None
+                if (into is not None and (dataset.width, dataset.height) == (tile.width, tile.height)
+                        and np.dtype(dataset.dtypes[0]) == np.dtype(dtype)
+                        and mosaic.same_nodata(tile_nodata, nodata)
+                        and scale == 1 and offset == 0):
+                    view = into.view(tile.row_off, tile.col_off, tile.height, tile.width)
+                if view is not None and view.shape[0] == dataset.count:
+                    dataset.read(out=view)
+                    data_array = None
+                else:
+                    data_array = dataset.read(out_shape=(dataset.count, tile.height, tile.width))
+            info = dict(info, decode_seconds=time.perf_counter() - start)
+            return data_array, tile_nodata, info
+
+        job = None
+        resumed = False
+        if resume and out_path is not None:
+            request = self.tile_key((), grid["res"], grid["tile_size"])
+            request.update({"transform": list(plan["transform"])[:6],
+                            "grid": grid,
+                            "width": plan["width"],
+                            "height": plan["height"],
+                            "trim": trim,
+                            "dtype": dtype,
+                            "scale": scale,
+                            "offset": offset})
+            job = jobs.Job(out_path, request)
+            resumed = job.load()
+
+        download_start = time.perf_counter()
+        first = None
+        if resumed:
+            dtype, nodata = job.dtype, job.nodata
+            tiles = [tile for tile in tiles if not job.is_done(tile.x_idx, tile.y_idx)]
+            instrument.logger.info("Resuming download to %s, %s blocks left", out_path, len(tiles))
+        else:
+            # The first tile decides the data type and nodata value of the mosaic
+            tile_dtype, tile_nodata = self.dtype, None
+            if tiles:
+                data, info = fetch_block(self, tiles[0])
+                first = (data, info, decode_block(tiles[0], data, info))
+                tile_dtype, tile_nodata = first[2][0].dtype, first[2][1]
+            if dtype is None:
+                dtype = tile_dtype
+            nodata = tile_nodata
+            if nodata is not None and (np.dtype(dtype) != np.dtype(tile_dtype) or scale != 1 or offset != 0):
+                nodata = mosaic.default_nodata(dtype)
+        stats.total = len(tiles)
+
+        mosaic_kw = {"resume": True} if resumed else {}
+        out = self.make_mosaic(out_path, self.bands, plan["height"], plan["width"],
+                               dtype, plan["transform"], tile_size=(tile_width, tile_length),
+                               tile_offset=plan["tile_offset"], nodata=nodata, scale=scale, offset=offset,
+                               **mosaic_kw)
+        if resumed:
+            for tile_id, status in job.tiles.items():
+                if status == "done":
+                    x_idx, y_idx = (int(idx) for idx in tile_id.split(","))
+                    out.valid_tiles[y_idx, x_idx] = True
+        elif job is not None:
+            job.start(dtype, nodata)
+
+        local = threading.local()
+
+        def download_block(tile):
+            if workers > 1:
+                if not hasattr(local, "connection"):
+                    local.connection = self.clone()
+                con = local.connection
+            else:
+                con = self
+            return fetch_block(con, tile)
+
+        def store_block(tile, data, info, decoded=None):
+            if decoded is None:
+                decoded = decode_block(tile, data, info, out)
+            data_array, tile_nodata, info = decoded
+            start = time.perf_counter()
+            if data_array is None:
+                out.mark(None, tile.row_off, tile.col_off)
+            else:
+                data_array = mosaic.convert(data_array, dtype, tile_nodata, nodata, scale, offset)
+                out.write(data_array, tile.row_off, tile.col_off)
+            stats.tile((tile.x_idx, tile.y_idx), write_seconds=time.perf_counter() - start, nbytes=info["bytes"],
+                       source=info["source"], fetch_seconds=info["fetch_seconds"],
+                       decode_seconds=info["decode_seconds"])
+
+        # Tiles are fetched by one pool of threads, and decoded and
+        # written by another. At most in_flight tiles are between being
+        # requested and written at a time, to bound the memory held by
+        # tiles waiting to be decoded.
+        decoders = decode_workers or os.cpu_count() or 1
+        in_flight = max(1, workers) + 2 * decoders
+        remaining = collections.deque(tiles[1:] if first is not None else tiles)
+        pending = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as fetcher, \
+                 concurrent.futures.ThreadPoolExecutor(decoders) as decoder:
+                try:
+                    if first is not None:
+                        pending[decoder.submit(store_block, tiles[0], *first)] = ("store", tiles[0])
+                        first = None
+                    while pending or remaining:
+                        while remaining and len(pending) < in_flight:
+                            tile = remaining.popleft()
+                            pending[fetcher.submit(download_block, tile)] = ("fetch", tile)
+                        done, _ = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            step, tile = pending.pop(future)
+                            if job is None:
+                                result = future.result()
+                            else:
+                                try:
+                                    result = future.result()
+                                except Exception as e:
+                                    instrument.logger.warning("Failed to download block %s,%s: %s", tile.x_idx + 1, tile.y_idx + 1, e)
+                                    job.failed(tile.x_idx, tile.y_idx, e)
+                                    continue
+                            if step == "fetch":
+                                pending[decoder.submit(store_block, tile, *result)] = ("store", tile)
+                            elif job is not None:
+                                job.done(tile.x_idx, tile.y_idx)
+                                if job.due():
+                                    # Only record tiles as done once they are on disk
+                                    out.checkpoint()
+                                    job.save()
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            out.close()
+            if job is not None:
+                job.save()
+            stats.record("download", time.perf_counter() - download_start)
+
+        if job is not None and job.failures():
+            raise RuntimeError("%s blocks failed to download, run the download again to retry them (see %s)" % (
+                len(job.failures()), job.path))
+
+        res = out.result()
+        res.update({"data": self.kw, "gdf": gdf, "tiles_skipped": skipped, "resolution": grid["res"],
+                    "stats": stats.summary()})
+        if self.cache is not None:
+            res["cache"] = {name: self.cache.stats()[name] - cache_stats[name] for name in ("hits", "misses")}
+            instrument.logger.info("Tile cache: %(hits)s hits, %(misses)s misses", res["cache"])
+        return res
+
+    def download_many(self, gdf, tif_res, workers=None, out_paths=None, buffer=None, snap=False, **kw):
+        """Downloads one raster per feature of gdf, see download().
+        out_paths is None or a list with one path per feature.
+
+        Whole tiles are downloaded (see plan_tiles()), and tiles needed
+        by several overlapping features are only downloaded once.
+        Returns a list of results, one per feature. kw (dtype, scale,
+        offset) is passed on to download()."""
+        gdf = gdf.to_crs(self.get_crs())
+        grid = self.get_grid(tif_res, snap)
+        uses = {}
+        for idx in range(len(gdf)):
+            plan = self.plan_tiles(self.get_aoi(gdf.iloc[[idx]], buffer), grid, trim=False)
+            for tile in plan["tiles"]:
+                key = tilecache.key(**self.tile_key(tile.bounds, grid["res"], grid["tile_size"]))
+                uses[key] = uses.get(key, 0) + 1
+        instrument.logger.info("Downloading %s features, sharing %s blocks",
+                               len(gdf), len([key for key, count in uses.items() if count > 1]))
+
+        self.memo = tilecache.TileMemo(uses)
+        try:
+            return [self.download(gdf.iloc[[idx]], tif_res, workers=workers,
+                                  out_path=out_paths[idx] if out_paths is not None else None,
+                                  buffer=buffer, snap=snap, trim=False, **kw)
+                    for idx in range(len(gdf))]
+        finally:
+            self.memo = None
+
+
+@functools.lru_cache(maxsize=None)
+def connection_types():
+    "Returns the registered connection type entry points by name, scanned once per process"
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        entry_points = entry_points.select(group='terrainy.connection')
+    else:
+        entry_points = entry_points.get('terrainy.connection', [])
+    return {entry.name: entry for entry in entry_points}
+
+
+@functools.lru_cache(maxsize=None)
+def connection_class(connection_type):
+    connections = connection_types()
+    if connection_type not in connections:
         raise NotImplementedError("Unknown connection type")
-    return connections[data["connection_type"]](**data)
+    return connections[connection_type].load()
+
+
+def connect(**data):
+    """Returns a connection for a source. No network requests are made
+    until the connection is actually used."""
+    return connection_class(data["connection_type"])(**data)
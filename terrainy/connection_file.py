@@ -0,0 +1,94 @@
+from . import connection
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterio.features
+import rasterio.windows
+import shapely.geometry
+import shapely.ops
+from rasterio.warp import Resampling
+
+# Pixels along the longer side of the data mask read to compute the
+# coverage of a file, see FileConnection.get_shape()
+coverage_mask_size = 1024
+
+
+class FileConnection(connection.Connection):
+    """A local raster file (GeoTIFF, Cloud Optimized GeoTIFF, VRT, or
+    anything else GDAL reads) as a source, e.g. a mirror written by
+    mirror.prefetch(). connection_args is {"url": path}.
+
+    Tiles are windowed reads of the file, at the requested resolution,
+    using its overviews where there are any, returned as arrays
+    (connection.ArrayTile) rather than encoded. No tile cache or proxy
+    is used, as they would only duplicate the file."""
+    file_format = "GeoTIFF"
+
+    def __init__(self, cache=None, proxy=None, **kw):
+        connection.Connection.__init__(self, cache=None, proxy=False, **kw)
+        # Opened lazily, and separately by every clone, as datasets can
+        # not be shared between threads
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            self._dataset = rasterio.open(self.kw["connection_args"]["url"])
+        return self._dataset
+
+    @property
+    def bands(self):
+        return self.dataset.count
+
+    @property
+    def dtype(self):
+        return self.dataset.dtypes[0]
+
+    def clone(self):
+        con = connection.Connection.clone(self)
+        con._dataset = None
+        return con
+
+    def get_host(self):
+        # Not a server; reads of local files need no concurrency limit
+        # shared with other sources
+        return "file:" + self.kw["connection_args"]["url"]
+
+    def download_tile(self, bounds, tif_res, size):
+        width, height = size
+        dataset = self.dataset
+        window = rasterio.windows.from_bounds(*bounds, transform=dataset.transform)
+        array = dataset.read(window=window, out_shape=(dataset.count, height, width), boundless=True,
+                             fill_value=dataset.nodata, resampling=Resampling.nearest)
+        return connection.ArrayTile(array, dataset.nodata, dataset.crs,
+                                    rasterio.transform.from_bounds(*bounds, width, height))
+
+    def get_shape(self, workers=None):
+        "Returns the coverage of the file, from its data mask, as a GeoDataFrame with a single geometry"
+        dataset = self.dataset
+        factor = max(1, int(np.ceil(max(dataset.width, dataset.height) / coverage_mask_size)))
+        shape = (max(1, dataset.height // factor), max(1, dataset.width // factor))
+        mask = dataset.dataset_mask(out_shape=shape)
+        transform = dataset.transform * rasterio.transform.Affine.scale(dataset.width / shape[1],
+                                                                       dataset.height / shape[0])
+        geometry = [shapely.geometry.shape(shp)
+                    for shp, val in rasterio.features.shapes((mask > 0).astype("uint8"), mask=mask > 0,
+                                                             transform=transform)
+                    if val > 0]
+        if not len(geometry):
+            raise ValueError("File has no data!")
+        return gpd.GeoDataFrame(
+            geometry=[shapely.ops.unary_union(geometry)]
+        ).set_crs(self.get_crs())
+
+    def get_native_grid(self):
+        transform = self.dataset.transform
+        return (transform.c, transform.f, transform.a)
+
+    def get_bounds(self):
+        return tuple(self.dataset.bounds)
+
+    def get_crs(self):
+        if self.kw.get("crs_orig"):
+            return self.kw["crs_orig"]
+        return self.dataset.crs.to_string()
@@ -1,14 +1,18 @@
 from . import connection
-import contextily
+from . import instrument
+from . import xyz
 import xyzservices.lib
 import numpy as np
+import time
 import geopandas as gpd
 import shapely.geometry
+import shapely.prepared
 from rasterio.transform import Affine
 
 class TileConnection(connection.Connection):
     bands = 3
     dtype = "uint8"
+    tile_size = 256
     
     def __init__(self, **kw):
         connection.Connection.__init__(self, **kw)
@@ -20,28 +24,100 @@ class TileConnection(connection.Connection):
 
     def get_shape(self):
         return gpd.GeoDataFrame(geometry=[shapely.geometry.box(*self.get_bounds())], crs=self.get_crs())
-        
-    def download(self, gdf, tif_res):
-        gdf = gdf.to_crs(self.get_crs())
-        xmin, ymin, xmax, ymax = gdf.total_bounds
 
+    def get_zoom(self, tif_res):
         world_bounds = self.get_bounds()
-
         # From definition of spherical mercator:
         # tif_res = (world_bounds[2] - world_bounds[0]) / (256 * 2**zoom)
-        zoom = int(np.ceil(np.log2((world_bounds[2] - world_bounds[0]) / (256 * tif_res))))
+        zoom = int(np.ceil(np.log2((world_bounds[2] - world_bounds[0]) / (self.tile_size * tif_res))))
+        return int(min(max(zoom, self.source.get("min_zoom", 0)), self.source.get("max_zoom", zoom)))
 
-        array, extent = contextily.bounds2img(xmin, ymin, xmax, ymax, ll=False, zoom=zoom, source=self.source)
-        array = np.transpose(array, (2, 0, 1))
+    def plan_xyz_tiles(self, aoi, zoom):
+        """Returns the transform, width and height (in tiles) of the
+        mosaic of the tiles covering aoi at a zoom level, the tiles
+        intersecting aoi as a list of (x, y, x_idx, y_idx), and the
+        number of skipped tiles."""
+        world_bounds = self.get_bounds()
+        tile_m = (world_bounds[2] - world_bounds[0]) / 2 ** zoom
+        xmin, ymin, xmax, ymax = aoi.bounds
+        x0 = int(np.floor((xmin - world_bounds[0]) / tile_m))
+        x1 = int(np.ceil((xmax - world_bounds[0]) / tile_m))
+        y0 = int(np.floor((world_bounds[3] - ymax) / tile_m))
+        y1 = int(np.ceil((world_bounds[3] - ymin) / tile_m))
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = max(min(x1, 2 ** zoom), x0 + 1), max(min(y1, 2 ** zoom), y0 + 1)
 
-        left, right, bottom, top = extent
-        xres = (right - left) / array.shape[2]
-        yres = (top - bottom) / array.shape[1]
-        
-        transform = Affine.translation(left, top) * Affine.scale(xres, -yres)
+        prepared_aoi = shapely.prepared.prep(aoi)
+        tiles = []
+        skipped = 0
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                bounds = (world_bounds[0] + x * tile_m, world_bounds[3] - (y + 1) * tile_m,
+                          world_bounds[0] + (x + 1) * tile_m, world_bounds[3] - y * tile_m)
+                if not prepared_aoi.intersects(shapely.geometry.box(*bounds)):
+                    skipped += 1
+                    continue
+                tiles.append((x, y, x - x0, y - y0))
+
+        res = tile_m / self.tile_size
+        transform = (Affine.translation(world_bounds[0] + x0 * tile_m, world_bounds[3] - y0 * tile_m)
+                     * Affine.scale(res, -res))
+        return transform, x1 - x0, y1 - y0, tiles, skipped
+
+    def download(self, gdf, tif_res, workers=None, out_path=None, buffer=None, origin=None, snap=False,
+                 resume=False, callback=None, trim=True):
+        """Downloads the XYZ tiles covering gdf at the zoom level
+        closest to tif_res, see Connection.download(). Tiles are
+        fetched asynchronously over a pooled HTTP/2 connection, at most
+        workers (default xyz.concurrency) at a time, and decoded in
+        worker threads, straight into the mosaic where possible. origin, snap and trim are ignored,
+        as tiles are always whole tiles on the global tile grid. Progress and timings
+        are reported to callback, see instrument.Stats."""
+        if resume:
+            raise NotImplementedError("Resumable downloads are not supported for tile sources")
+        if workers is None:
+            workers = xyz.concurrency
+        stats = instrument.Stats(callback)
+        with stats.stage("plan"):
+            gdf = gdf.to_crs(self.get_crs())
+            zoom = self.get_zoom(tif_res)
+            transform, nr_cols, nr_rows, tiles, skipped = self.plan_xyz_tiles(self.get_aoi(gdf, buffer), zoom)
+        if skipped:
+            instrument.logger.info("Skipping %s of %s tiles outside the area of interest", skipped, nr_cols * nr_rows)
+        stats.total = len(tiles)
+
+        out = self.make_mosaic(out_path, self.bands, nr_rows * self.tile_size, nr_cols * self.tile_size,
+                               self.dtype, transform, tile_size=(self.tile_size, self.tile_size))
+
+        def handle(tile, data, info):
+            x, y, x_idx, y_idx = tile
+            row_off, col_off = y_idx * self.tile_size, x_idx * self.tile_size
+            start = time.perf_counter()
+            view = out.view(row_off, col_off, self.tile_size, self.tile_size)
+            data_array = xyz.decode(data, self.bands, view)
+            decoded = time.perf_counter()
+            if view is not None and data_array is view:
+                # Decoded in place
+                out.mark(None, row_off, col_off)
+            else:
+                out.write(data_array, row_off, col_off)
+            stats.tile((x_idx, y_idx), len(data), info["source"], info["fetch_seconds"],
+                       decoded - start, time.perf_counter() - decoded)
+
+        requests = [(self.source.build_url(x=tile[0], y=tile[1], z=zoom), tile) for tile in tiles]
+        try:
+            with stats.stage("download"):
+                xyz.run(xyz.fetch_tiles(requests, handle, cache=self.cache, concurrency=workers,
+                                        decoders=connection.decode_workers))
+        finally:
+            out.close()
+
+        res = out.result()
         data = dict(self.kw)
         data["crs_orig"] = self.get_crs()
-        return {"array":array, "transform":transform, "data":data, "gdf":gdf}
+        res.update({"data": data, "gdf": gdf, "tiles_skipped": skipped, "resolution": transform.a,
+                    "stats": stats.summary()})
+        return res
 
     def download_tile(self, bounds, tif_res, size):        
         raise NotImplementedError("Use download()")
@@ -1,14 +1,47 @@
 from . import connection
+from . import capabilities
+from . import instrument
 from owslib.wcs import WebCoverageService
+from owslib.coverage.wcsBase import WCSCapabilitiesReader
+from owslib.etree import etree
 
 class WcsConnection(connection.Connection):
     bands = 1
-    dtype = "float64"
+    # Used only when no tiles are downloaded, otherwise the data type
+    # of the returned tiles is used
+    dtype = "float32"
+    file_format = "GeoTIFF"
     
     def __init__(self, **kw):
         connection.Connection.__init__(self, **kw)
-        self.wcs = WebCoverageService(**self.kw["connection_args"])
-        self.layer = self.wcs[self.kw["layer"]]
+        # The service is set up lazily, on first use, from a cached
+        # capabilities document, see capabilities.get()
+        self._wcs = None
+        self._layer = None
+
+    @property
+    def wcs(self):
+        if self._wcs is None:
+            args = dict(self.kw["connection_args"])
+            url = WCSCapabilitiesReader(args.get("version")).capabilities_url(args["url"])
+            args["xml"] = capabilities.get(url, headers=args.get("headers"), timeout=args.get("timeout", 30))
+            self._wcs = WebCoverageService(**args)
+        return self._wcs
+
+    @property
+    def layer(self):
+        if self._layer is None:
+            self._layer = self.wcs[self.kw["layer"]]
+        return self._layer
+
+    def clone(self):
+        # Give the copy its own owslib service object, parsed from the
+        # capabilities we already have rather than refetched
+        con = connection.Connection.clone(self)
+        args = dict(self.kw["connection_args"])
+        args.update({"version": self.wcs.version, "xml": etree.tostring(self.wcs._capabilities)})
+        con._wcs = WebCoverageService(**args)
+        return con
 
     def download_tile(self, bounds, tif_res, size):
         return self.wcs.getCoverage(
@@ -16,10 +49,32 @@ class WcsConnection(connection.Connection):
             crs=self.get_crs(),
             bbox=bounds,
             resx=tif_res, resy=tif_res,
-            format='GeoTIFF')
+            format=self.file_format)
+
+    def get_native_grid(self):
+        # From the DescribeCoverage document, see owslib.coverage.wcs100.ContentMetadata.grid
+        try:
+            grid = self.layer.grid
+        except Exception as e:
+            instrument.logger.warning("Unable to read the native grid of %s: %s", self.kw["layer"], e)
+            return None
+        if getattr(grid, "offsetvectors", None) and getattr(grid, "origin", None):
+            xres = abs(float(grid.offsetvectors[0][0]))
+            yres = abs(float(grid.offsetvectors[-1][-1]))
+            # The GML origin is the center of the first pixel
+            return (float(grid.origin[0]) - xres / 2, float(grid.origin[1]) + yres / 2, xres)
+        if getattr(grid, "highlimits", None):
+            bbox = self.get_bounds()
+            width = int(grid.highlimits[0]) - int(grid.lowlimits[0]) + 1
+            return (bbox[0], bbox[3], (bbox[2] - bbox[0]) / width)
+        return None
 
     def get_bounds(self):
         return self.layer.boundingboxes[0]["bbox"]
         
     def get_crs(self):
+        # Known from the source catalog, so that we don't need a
+        # DescribeCoverage round trip just to look up cached tiles
+        if self.kw.get("crs_orig"):
+            return self.kw["crs_orig"]
         return self.layer.boundingboxes[0]["nativeSrs"]
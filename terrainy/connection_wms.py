@@ -1,5 +1,8 @@
 from . import connection
+from . import capabilities
 from owslib.wms import WebMapService
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.etree import etree
 
 class WmsConnection(connection.Connection):
     bands = 3
@@ -11,11 +14,71 @@ class WmsConnection(connection.Connection):
     
     def __init__(self, **kw):
         connection.Connection.__init__(self, **kw)
-        self.wms = WebMapService(**self.kw["connection_args"])
-        self.layer = self.wms[self.kw["layer"]]
+        # The service is set up lazily, on first use, from a cached
+        # capabilities document, see capabilities.get()
+        self._wms = None
+        self._layer = None
+        self._file_format = None
 
-        supported = self.wms.getOperationByName('GetMap').formatOptions
-        self.file_format = [fmt for fmt in self.formats if fmt in supported][0]
+    @property
+    def wms(self):
+        if self._wms is None:
+            args = dict(self.kw["connection_args"])
+            # The tile format is ours, not an argument of owslib
+            args.pop("format", None)
+            url = WMSCapabilitiesReader(args.get("version", "1.1.1")).capabilities_url(args["url"])
+            auth = None
+            if args.get("username"):
+                auth = (args["username"], args.get("password"))
+            args["xml"] = capabilities.get(
+                url, headers=args.get("headers"), timeout=args.get("timeout", 30), auth=auth)
+            self._wms = WebMapService(**args)
+        return self._wms
+
+    @property
+    def layer(self):
+        if self._layer is None:
+            self._layer = self.wms[self.kw["layer"]]
+        return self._layer
+
+    @property
+    def file_format(self):
+        "The format of connection_args, or the first of formats the server supports"
+        if self._file_format is None:
+            self._file_format = self.kw["connection_args"].get("format")
+        if self._file_format is None:
+            supported = self.wms.getOperationByName('GetMap').formatOptions
+            self._file_format = [fmt for fmt in self.formats if fmt in supported][0]
+        return self._file_format
+
+    def tile_format(self):
+        # Only a format set in connection_args, not the one negotiated
+        # from the capabilities, so that looking up cached tiles does
+        # not need the capabilities. Tiles open whatever their format.
+        return self.kw["connection_args"].get("format")
+
+    def clone(self):
+        # Give the copy its own owslib service object, parsed from the
+        # capabilities we already have rather than refetched
+        con = connection.Connection.clone(self)
+        args = dict(self.kw["connection_args"])
+        args.pop("format", None)
+        args.update({"version": self.wms.version, "xml": etree.tostring(self.wms._capabilities)})
+        con._wms = WebMapService(**args)
+        return con
+
+    def get_max_tile_size(self):
+        # MaxWidth / MaxHeight of the Service section, which owslib
+        # does not parse. WMS 1.3.0 elements are namespaced.
+        limits = {}
+        service = [elem for elem in self.wms._capabilities if elem.tag.split("}")[-1] == "Service"]
+        for elem in (service[0] if service else []):
+            name = elem.tag.split("}")[-1]
+            if name in ("MaxWidth", "MaxHeight") and elem.text and elem.text.strip().isdigit():
+                limits[name] = int(elem.text)
+        if not limits:
+            return None
+        return (limits.get("MaxWidth", limits.get("MaxHeight")), limits.get("MaxHeight", limits.get("MaxWidth")))
 
     def download_tile(self, bounds, tif_res, size):
         return self.wms.getmap(layers=[self.layer.id],
@@ -28,4 +91,8 @@ class WmsConnection(connection.Connection):
         return self.layer.boundingBox[:4]
 
     def get_crs(self):
+        # Known from the source catalog, so that we don't need the
+        # capabilities just to look up cached tiles
+        if self.kw.get("crs_orig"):
+            return self.kw["crs_orig"]
         return self.layer.boundingBox[4]
@@ -0,0 +1,100 @@
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger("terrainy")
+
+
+def totals(values):
+    "Summary of a list of durations in seconds"
+    if not values:
+        return {"count": 0, "total": 0.0, "mean": 0.0, "max": 0.0}
+    return {"count": len(values), "total": sum(values), "mean": sum(values) / len(values), "max": max(values)}
+
+
+class Stats(object):
+    """Collects timings and byte counts of a download or export.
+
+    Each event is passed, as a dictionary, to callback (if given) and
+    logged to the "terrainy" logger. There are two kinds of events:
+
+    {"event": "tile", "done", "total", "tile", "bytes", "source",
+     "fetch_seconds", "decode_seconds", "write_seconds"}
+        for every tile, as it is written. source is "server",
+        "cache" (the tile cache) or "memo" (see cache.TileMemo), and
+        fetch_seconds is the request latency for tiles from the
+        server.
+
+    {"event": "stage", "stage", "seconds"}
+        when a stage (e.g. "plan", "download", "reproject", "crop",
+        "write") is finished.
+
+    summary() returns the totals, and is returned with the result as
+    "stats"."""
+
+    def __init__(self, callback=None, total=0):
+        self.callback = callback
+        self.total = total
+        self.done = 0
+        self.bytes = 0
+        self.sources = {}
+        self.fetch = []
+        self.decode = []
+        self.write = []
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        if event["event"] == "tile":
+            logger.debug("Tile %(tile)s (%(done)s/%(total)s): %(bytes)s bytes from %(source)s", event)
+        else:
+            logger.info("Stage %(stage)s took %(seconds).3fs", event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def tile(self, tile, nbytes, source, fetch_seconds, decode_seconds, write_seconds):
+        "Records a tile that has been written"
+        with self.lock:
+            self.done += 1
+            self.bytes += nbytes
+            self.sources[source] = self.sources.get(source, 0) + 1
+            if source == "server":
+                self.fetch.append(fetch_seconds)
+            self.decode.append(decode_seconds)
+            self.write.append(write_seconds)
+            event = {"event": "tile",
+                     "done": self.done,
+                     "total": self.total,
+                     "tile": tile,
+                     "bytes": nbytes,
+                     "source": source,
+                     "fetch_seconds": fetch_seconds,
+                     "decode_seconds": decode_seconds,
+                     "write_seconds": write_seconds}
+        self.emit(event)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        "Times a stage"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        "Records that a stage took seconds"
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+        self.emit({"event": "stage", "stage": name, "seconds": seconds})
+
+    def summary(self):
+        with self.lock:
+            return {"stages": dict(self.stages),
+                    "tiles": self.done,
+                    "bytes": self.bytes,
+                    "sources": dict(self.sources),
+                    "fetch_seconds": totals(self.fetch),
+                    "decode_seconds": totals(self.decode),
+                    "write_seconds": totals(self.write)}
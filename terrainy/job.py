@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import time
+from . import instrument
+
+# Minimum number of seconds between saves of the manifest of a
+# running job
+checkpoint_interval = 10
+
+
+def manifest_path(out_path):
+    "Path of the job manifest kept next to the output file out_path"
+    return out_path + ".job.json"
+
+
+class Job(object):
+    """Manifest of a resumable download to a file: the request
+    parameters, the data type and nodata value of the output file, and
+    the status ("done" or "failed") of each planned tile.
+
+    The manifest is saved next to the output file, and loaded again
+    by a later download of the same request (identical parameters) to
+    the same file, which then only fetches tiles not yet done."""
+
+    def __init__(self, out_path, request):
+        self.out_path = out_path
+        self.path = manifest_path(out_path)
+        # Normalized to what it looks like when read back
+        self.request = json.loads(json.dumps(request, default=str))
+        self.dtype = None
+        self.nodata = None
+        self.tiles = {}
+        self.errors = {}
+        self.saved = 0
+
+    @staticmethod
+    def tile_id(x_idx, y_idx):
+        return "%s,%s" % (x_idx, y_idx)
+
+    def load(self):
+        """Loads the status of an earlier run of the same request.
+        Returns False if there is none, i.e. the job starts afresh."""
+        if not os.path.exists(self.path) or not os.path.exists(self.out_path):
+            return False
+        with open(self.path) as f:
+            manifest = json.load(f)
+        if manifest.get("request") != self.request:
+            instrument.logger.warning("Job manifest %s is for a different request, starting over", self.path)
+            return False
+        self.dtype = manifest["dtype"]
+        self.nodata = manifest["nodata"]
+        self.tiles = manifest["tiles"]
+        self.errors = manifest.get("errors", {})
+        return True
+
+    def start(self, dtype, nodata):
+        self.dtype = str(dtype)
+        self.nodata = None if nodata is None else float(nodata)
+        self.tiles = {}
+        self.errors = {}
+        self.save()
+
+    def is_done(self, x_idx, y_idx):
+        return self.tiles.get(self.tile_id(x_idx, y_idx)) == "done"
+
+    def done(self, x_idx, y_idx):
+        tile_id = self.tile_id(x_idx, y_idx)
+        self.tiles[tile_id] = "done"
+        self.errors.pop(tile_id, None)
+
+    def failed(self, x_idx, y_idx, error):
+        tile_id = self.tile_id(x_idx, y_idx)
+        self.tiles[tile_id] = "failed"
+        self.errors[tile_id] = str(error)
+
+    def failures(self):
+        return [tile_id for tile_id, status in self.tiles.items() if status == "failed"]
+
+    def due(self):
+        "True if the manifest has not been saved for checkpoint_interval seconds"
+        return time.time() - self.saved > checkpoint_interval
+
+    def save(self):
+        "Writes the manifest atomically, so that it is never seen half written"
+        data = json.dumps({"request": self.request,
+                           "dtype": self.dtype,
+                           "nodata": self.nodata,
+                           "tiles": self.tiles,
+                           "errors": self.errors})
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmpname, self.path)
+        self.saved = time.time()
@@ -0,0 +1,53 @@
+import math
+import os
+import rasterio
+import rasterio.shutil
+from . import connection
+from . import job as jobs
+from . import sources
+from . import warp
+
+
+def overview_count(tif_res, max_res):
+    "Number of overview levels, each halving the resolution, needed to get from tif_res to max_res"
+    return max(0, int(math.ceil(math.log2(max_res / tif_res))))
+
+
+def prefetch(title, gdf, tif_res, out_path, max_res=None, cache=True, workers=None, buffer=None, snap=False,
+             resume=False, compress=None, callback=None):
+    """Mirrors the source title over gdf into a Cloud Optimized GeoTIFF
+    at out_path, for offline use as a "file" source (see
+    connection_file.FileConnection and register()).
+
+    The source is downloaded at tif_res, streamed to a temporary file
+    next to out_path (so that with resume an interrupted prefetch
+    picks up where it left off, see Connection.download()), and then
+    written as a COG with overviews from tif_res up to max_res
+    (default: down to a single block), i.e. a pyramid that serves
+    downloads at any resolution in that range with windowed reads.
+
+    Returns the result of the download, with "path" set to out_path."""
+    con = connection.connect(cache=cache, **sources.get(title))
+    download_path = out_path + ".download.tif"
+    res = con.download(gdf, tif_res, workers=workers, out_path=download_path, buffer=buffer, snap=snap,
+                       resume=resume, callback=callback)
+    overviews = True if max_res is None else overview_count(res["resolution"], max_res)
+    tmp_path = out_path + ".tmp"
+    with rasterio.open(download_path) as src:
+        rasterio.shutil.copy(src, tmp_path, driver="COG",
+                             **warp.cog_options(src.dtypes[0], compress, overviews=overviews))
+    os.replace(tmp_path, out_path)
+    os.remove(download_path)
+    if os.path.exists(jobs.manifest_path(download_path)):
+        os.remove(jobs.manifest_path(download_path))
+    res["path"] = out_path
+    return res
+
+
+def register(title, path, layer=None):
+    """Adds the mirror at path (see prefetch()) to the source catalog as
+    a "file" source called title. layer defaults to the file name."""
+    sources.add_source(title=title,
+                       connection_type="file",
+                       connection_args={"url": os.path.abspath(path)},
+                       layer=layer or os.path.basename(path))
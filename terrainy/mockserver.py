@@ -0,0 +1,306 @@
+"""A local stand-in for WCS, WMS and XYZ tile servers, serving
+synthetic tiles, for benchmarks (see benchmark.py) and offline
+experiments. WCS and WMS tiles can be requested in any crs.
+
+    with MockServer(latency=0.05) as server:
+        data = server.source("wcs")
+        con = connection.connect(**data)
+"""
+import http.server
+import threading
+import time
+import urllib.parse
+import warnings
+import numpy as np
+from rasterio import MemoryFile
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import from_bounds
+from rasterio.warp import transform
+
+# PNG tiles carry no georeferencing
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning, message=".*no geotransform.*")
+
+# Extent of the synthetic coverage, in crs
+crs = "EPSG:25833"
+bounds = (400000.0, 6500000.0, 700000.0, 6800000.0)
+native_res = 1.0
+
+layer = "synthetic"
+
+
+def terrain(xs, ys):
+    """Synthetic terrain heights at the coordinates xs, ys: smooth
+    hills plus a pseudo random roughness, so that tiles compress
+    about as well as real terrain"""
+    hills = 200 + 150 * np.sin(xs / 1500.0) * np.cos(ys / 2300.0) + 40 * np.sin((xs + ys) / 400.0)
+    roughness = np.modf(np.sin(xs * 12.9898 + ys * 78.233) * 43758.5453)[0]
+    return (hills + roughness).astype("float32")
+
+
+def render(bbox, width, height, kind, tile_crs=crs):
+    """Returns the bytes of a tile of width x height pixels covering
+    bbox (in tile_crs): a float32 GeoTIFF for kind "geotiff", an RGB
+    PNG for "png"."""
+    xmin, ymin, xmax, ymax = bbox
+    xs = xmin + (np.arange(width) + 0.5) * (xmax - xmin) / width
+    ys = ymax - (np.arange(height) + 0.5) * (ymax - ymin) / height
+    if tile_crs == crs:
+        heights = terrain(xs[None, :], ys[:, None])
+    else:
+        xs, ys = np.meshgrid(xs, ys)
+        xs, ys = transform(tile_crs, crs, xs.ravel(), ys.ravel())
+        heights = terrain(np.array(xs), np.array(ys)).reshape(height, width)
+    with MemoryFile() as memfile:
+        if kind == "geotiff":
+            with memfile.open(driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                              crs=tile_crs, transform=from_bounds(*bbox, width, height)) as dataset:
+                dataset.write(heights[None])
+        else:
+            shade = np.clip(heights / 450 * 255, 0, 255).astype("uint8")
+            rgb = np.stack([shade, 255 - shade, np.full_like(shade, 128)])
+            with memfile.open(driver="PNG", width=width, height=height, count=3, dtype="uint8") as dataset:
+                dataset.write(rgb)
+        return memfile.read()
+
+
+def wcs_capabilities(url):
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<WCS_Capabilities xmlns="http://www.opengis.net/wcs" xmlns:gml="http://www.opengis.net/gml"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <Service><name>WCS</name><label>terrainy mock server</label><fees>NONE</fees><accessConstraints>NONE</accessConstraints></Service>
+  <Capability>
+    <Request>
+      <GetCapabilities><DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetCapabilities>
+      <DescribeCoverage><DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></DescribeCoverage>
+      <GetCoverage><DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetCoverage>
+    </Request>
+    <Exception><Format>application/vnd.ogc.se_xml</Format></Exception>
+  </Capability>
+  <ContentMetadata>
+    <CoverageOfferingBrief>
+      <name>%(layer)s</name>
+      <label>%(layer)s</label>
+      <lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84">
+        <gml:pos>13.0 58.6</gml:pos><gml:pos>18.3 61.4</gml:pos>
+      </lonLatEnvelope>
+    </CoverageOfferingBrief>
+  </ContentMetadata>
+</WCS_Capabilities>""" % {"url": url, "layer": layer}
+
+
+def wcs_describe_coverage():
+    width = int((bounds[2] - bounds[0]) / native_res)
+    height = int((bounds[3] - bounds[1]) / native_res)
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<CoverageDescription xmlns="http://www.opengis.net/wcs" xmlns:gml="http://www.opengis.net/gml" version="1.0.0">
+  <CoverageOffering>
+    <name>%(layer)s</name>
+    <domainSet><spatialDomain>
+      <gml:Envelope srsName="%(crs)s"><gml:pos>%(xmin)s %(ymin)s</gml:pos><gml:pos>%(xmax)s %(ymax)s</gml:pos></gml:Envelope>
+      <gml:RectifiedGrid dimension="2" srsName="%(crs)s">
+        <gml:limits><gml:GridEnvelope><gml:low>0 0</gml:low><gml:high>%(high_x)s %(high_y)s</gml:high></gml:GridEnvelope></gml:limits>
+        <gml:axisName>x</gml:axisName><gml:axisName>y</gml:axisName>
+        <gml:origin><gml:pos>%(origin_x)s %(origin_y)s</gml:pos></gml:origin>
+        <gml:offsetVector>%(res)s 0</gml:offsetVector>
+        <gml:offsetVector>0 -%(res)s</gml:offsetVector>
+      </gml:RectifiedGrid>
+    </spatialDomain></domainSet>
+    <supportedCRSs><requestResponseCRSs>%(crs)s</requestResponseCRSs></supportedCRSs>
+    <supportedFormats><formats>GeoTIFF</formats></supportedFormats>
+  </CoverageOffering>
+</CoverageDescription>""" % {"layer": layer, "crs": crs, "res": native_res,
+                              "xmin": bounds[0], "ymin": bounds[1], "xmax": bounds[2], "ymax": bounds[3],
+                              "high_x": width - 1, "high_y": height - 1,
+                              "origin_x": bounds[0] + native_res / 2, "origin_y": bounds[3] - native_res / 2}
+
+
+def wms_capabilities(url, max_size):
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Service><Name>OGC:WMS</Name><Title>terrainy mock server</Title><MaxWidth>%(max_size)s</MaxWidth><MaxHeight>%(max_size)s</MaxHeight></Service>
+  <Capability>
+    <Request>
+      <GetCapabilities><Format>application/vnd.ogc.wms_xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetCapabilities>
+      <GetMap><Format>image/png</Format>
+        <DCPType><HTTP><Get><OnlineResource xlink:href="%(url)s"/></Get></HTTP></DCPType></GetMap>
+    </Request>
+    <Exception><Format>application/vnd.ogc.se_xml</Format></Exception>
+    <Layer>
+      <Title>terrainy mock server</Title>
+      <SRS>%(crs)s</SRS>
+      <Layer queryable="0">
+        <Name>%(layer)s</Name>
+        <Title>%(layer)s</Title>
+        <SRS>%(crs)s</SRS>
+        <LatLonBoundingBox minx="13.0" miny="58.6" maxx="18.3" maxy="61.4"/>
+        <BoundingBox SRS="%(crs)s" minx="%(xmin)s" miny="%(ymin)s" maxx="%(xmax)s" maxy="%(ymax)s"/>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>""" % {"url": url, "layer": layer, "crs": crs, "max_size": max_size,
+                              "xmin": bounds[0], "ymin": bounds[1], "xmax": bounds[2], "ymax": bounds[3]}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, data, content_type, status=200):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        # Counted before the client can see the response
+        self.server.mock.count(len(data))
+        self.wfile.write(data)
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urllib.parse.urlsplit(self.path)
+        params = {key.lower(): value for key, value in urllib.parse.parse_qsl(url.query)}
+        try:
+            if url.path.startswith("/xyz/"):
+                time.sleep(mock.latency)
+                if self.failed():
+                    return
+                z, x, y = (int(part) for part in url.path[len("/xyz/"):].split(".")[0].split("/"))
+                world = 20037508.342789244
+                tile_m = 2 * world / 2 ** z
+                bbox = (-world + x * tile_m, world - (y + 1) * tile_m, -world + (x + 1) * tile_m, world - y * tile_m)
+                self.send(render(bbox, mock.tile_size, mock.tile_size, "png"), "image/png")
+            elif url.path == "/wcs":
+                request = params.get("request", "").lower()
+                if request == "getcapabilities":
+                    self.send(wcs_capabilities(mock.url + "/wcs"), "application/xml")
+                elif request == "describecoverage":
+                    self.send(wcs_describe_coverage(), "application/xml")
+                elif request == "getcoverage":
+                    time.sleep(mock.latency)
+                    if self.failed():
+                        return
+                    bbox = [float(v) for v in params["bbox"].split(",")]
+                    width = int(round((bbox[2] - bbox[0]) / float(params["resx"])))
+                    height = int(round((bbox[3] - bbox[1]) / float(params["resy"])))
+                    self.check_size(width, height)
+                    self.send(render(bbox, width, height, "geotiff", params.get("crs", crs)), "image/tiff")
+                else:
+                    raise ValueError("Unsupported request %s" % request)
+            elif url.path == "/wms":
+                request = params.get("request", "").lower()
+                if request == "getcapabilities":
+                    self.send(wms_capabilities(mock.url + "/wms", mock.max_size), "application/vnd.ogc.wms_xml")
+                elif request == "getmap":
+                    time.sleep(mock.latency)
+                    if self.failed():
+                        return
+                    bbox = [float(v) for v in params["bbox"].split(",")]
+                    width, height = int(params["width"]), int(params["height"])
+                    self.check_size(width, height)
+                    self.send(render(bbox, width, height, "png", params.get("srs", crs)), "image/png")
+                else:
+                    raise ValueError("Unsupported request %s" % request)
+            else:
+                self.send("Not found", "text/plain", 404)
+        except (ValueError, KeyError) as e:
+            self.send("Bad request: %s" % e, "text/plain", 400)
+
+    def failed(self):
+        "Answers with the next failure of the server, if any. Returns whether it did."
+        status = self.server.mock.next_failure()
+        if status is None:
+            return False
+        self.send("Request failed with status %s" % status, "text/plain", status)
+        return True
+
+    def check_size(self, width, height):
+        if width > self.server.mock.max_size or height > self.server.mock.max_size:
+            raise ValueError("Requested size %sx%s exceeds %s" % (width, height, self.server.mock.max_size))
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class MockServer(object):
+    """Serves synthetic WCS (1.0.0, GeoTIFF), WMS (1.1.1, PNG) and XYZ
+    (PNG) tiles of the same terrain on localhost, in a background
+    thread.
+
+    latency is the number of seconds each tile request takes,
+    tile_size the size of XYZ tiles, and max_size the largest WCS /
+    WMS tile (in pixels each way) the server accepts. The number of
+    requests and bytes served are counted in requests and bytes.
+    fail() makes the next tile requests fail, e.g. to test retries."""
+
+    def __init__(self, latency=0.0, tile_size=256, max_size=4096, port=0):
+        self.latency = latency
+        self.tile_size = tile_size
+        self.max_size = max_size
+        self.requests = 0
+        self.bytes = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = Server(("127.0.0.1", port), Handler)
+        self.server.mock = self
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = None
+
+    def count(self, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.failures = []
+
+    def fail(self, *statuses):
+        """Answers the next tile requests, one for each status (e.g.
+        429), with that HTTP status and a plain text body instead of a
+        tile"""
+        with self.lock:
+            self.failures.extend(statuses)
+
+    def next_failure(self):
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def source(self, connection_type):
+        """Returns a source definition (as in the source catalog, see
+        sources.py) for the server, for connection_type "wcs", "wms" or
+        "tile" """
+        if connection_type == "tile":
+            return {"title": "Mock XYZ",
+                    "connection_type": "tile",
+                    "connection_args": {"url": self.url + "/xyz/{z}/{x}/{y}.png", "max_zoom": 19},
+                    "layer": None,
+                    "crs_orig": "EPSG:3857"}
+        return {"title": "Mock %s" % connection_type.upper(),
+                "connection_type": connection_type,
+                "connection_args": {"url": "%s/%s" % (self.url, connection_type)},
+                "layer": layer,
+                "crs_orig": crs}
@@ -0,0 +1,225 @@
+import threading
+import numpy as np
+import rasterio
+import rasterio.windows
+
+# Creation options for the tiled GeoTIFFs written by FileMosaic and
+# by the export functions of warp.py. Tiles of multiples of 512 pixels
+# align with the internal 512x512 blocks.
+gtiff_profile = {
+    "driver": "GTiff",
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "BIGTIFF": "IF_SAFER",
+}
+
+# Default compression of GeoTIFF, COG and VRT tile output. "zstd" and
+# "lzw" are also supported.
+default_compress = "deflate"
+
+
+def default_predictor(dtype):
+    "TIFF predictor suitable for dtype: floating point (3) for floats, horizontal differencing (2) otherwise"
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return 3
+    return 2
+
+
+def compression_profile(dtype, compress=None, predictor=None):
+    "Creation options for compress and predictor, filling in the defaults"
+    if compress is None:
+        compress = default_compress
+    if not compress or compress.lower() == "none":
+        return {}
+    if predictor is None:
+        predictor = default_predictor(dtype)
+    return {"compress": compress, "predictor": predictor}
+
+
+def is_nan(value):
+    "Whether value (e.g. a nodata value, which may be None) is NaN"
+    return isinstance(value, (float, np.floating)) and np.isnan(value)
+
+
+def same_nodata(a, b):
+    "Whether two nodata values are the same, where NaN is the same as NaN"
+    return a == b or (is_nan(a) and is_nan(b))
+
+
+def nodata_mask(array, nodata):
+    "Returns a boolean mask of the pixels of array equal to nodata, which may be NaN"
+    if is_nan(nodata):
+        return np.isnan(array)
+    return array == nodata
+
+
+def convert(array, dtype, nodata=None, dst_nodata=None, scale=1, offset=0):
+    """Converts tile data to dtype, storing (value - offset) / scale.
+    Pixels equal to nodata (which may be NaN) become dst_nodata.
+    Raises ValueError if values fall outside the range of an integer
+    dtype."""
+    if np.dtype(dtype) == array.dtype and scale == 1 and offset == 0 and same_nodata(nodata, dst_nodata):
+        return array
+    mask = None if nodata is None else nodata_mask(array, nodata)
+    res = array
+    if scale != 1 or offset != 0:
+        res = (res - offset) / scale
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        res = np.round(res)
+        values = res if mask is None else res[~mask]
+        if values.size and (values.min() < info.min or values.max() > info.max):
+            raise ValueError("Values from %s to %s do not fit in %s with scale %s and offset %s" % (
+                values.min() * scale + offset, values.max() * scale + offset, np.dtype(dtype), scale, offset))
+        if mask is not None:
+            # NaN can not be cast, it is replaced by dst_nodata below
+            res[mask] = 0
+    res = res.astype(dtype)
+    if mask is not None:
+        res[mask] = dst_nodata
+    return res
+
+
+def default_nodata(dtype):
+    "Nodata value to use for dtype when the source has none"
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return -9999
+    if np.dtype(dtype) == np.uint8:
+        return 0
+    return np.iinfo(dtype).min
+
+
+class Mosaic(object):
+    """Base class for mosaics of downloaded tiles. Keeps track of which
+    tiles of tile_size (width, height) pixels have been written in a
+    boolean grid (valid_tiles), so that missing tiles can be told
+    apart from real data without any sentinel values in the data
+    itself.
+
+    The mosaic starts tile_offset (col, row) pixels into its first
+    tile, so the tiles on its edges may be partial."""
+
+    def __init__(self, bands, height, width, dtype, transform, crs, tile_size=(1024, 1024),
+                 tile_offset=(0, 0), nodata=None, scale=1, offset=0):
+        self.transform = transform
+        self.crs = crs
+        self.tile_size = tile_size
+        self.tile_offset = tuple(tile_offset)
+        self.nodata = nodata
+        self.scale = scale
+        self.offset = offset
+        self.valid_tiles = np.zeros((-(-(height + tile_offset[1]) // tile_size[1]),
+                                     -(-(width + tile_offset[0]) // tile_size[0])), dtype=bool)
+
+    def mark(self, data, row_off, col_off):
+        self.valid_tiles[(row_off + self.tile_offset[1]) // self.tile_size[1],
+                         (col_off + self.tile_offset[0]) // self.tile_size[0]] = True
+
+    def view(self, row_off, col_off, height, width):
+        """Returns the part of the mosaic covered by a tile of height x
+        width pixels written at row_off, col_off, as an array to decode
+        the tile straight into, or None if that is not possible. Call
+        mark() once the tile is in place."""
+        return None
+
+    @staticmethod
+    def clip(data, row_off, col_off, height, width):
+        """Clips a tile written at row_off, col_off to a mosaic of
+        height x width pixels. Whole tiles may start before or overhang
+        the edges of the mosaic. Returns the data and window (row_off,
+        col_off, height, width) to write."""
+        top, left = max(0, -row_off), max(0, -col_off)
+        row_off, col_off = row_off + top, col_off + left
+        return (data[:, top:top + max(0, height - row_off), left:left + max(0, width - col_off)],
+                row_off, col_off)
+
+    def close(self):
+        pass
+
+    def result(self):
+        return {"transform": self.transform,
+                "nodata": self.nodata,
+                "scale": self.scale,
+                "offset": self.offset,
+                "tile_size": self.tile_size,
+                "tile_offset": self.tile_offset,
+                "valid_tiles": self.valid_tiles}
+
+
+class ArrayMosaic(Mosaic):
+    """Mosaic of downloaded tiles held in memory as a numpy array.
+    The array is zero initialized, so memory for tiles that are never
+    written is never touched."""
+
+    def __init__(self, bands, height, width, dtype, transform, crs, **kw):
+        Mosaic.__init__(self, bands, height, width, dtype, transform, crs, **kw)
+        self.array = np.zeros((bands, height, width), dtype=dtype)
+
+    def write(self, data, row_off, col_off):
+        self.mark(data, row_off, col_off)
+        data, row_off, col_off = self.clip(data, row_off, col_off, self.array.shape[1], self.array.shape[2])
+        self.array[:, row_off:row_off + data.shape[1], col_off:col_off + data.shape[2]] = data
+
+    def view(self, row_off, col_off, height, width):
+        if row_off < 0 or col_off < 0 or row_off + height > self.array.shape[1] or col_off + width > self.array.shape[2]:
+            return None
+        return self.array[:, row_off:row_off + height, col_off:col_off + width]
+
+    def result(self):
+        res = Mosaic.result(self)
+        res["array"] = self.array
+        return res
+
+
+class FileMosaic(Mosaic):
+    """Mosaic of downloaded tiles streamed to a tiled GeoTIFF file.
+    Each tile is written to its window as soon as it arrives, so only
+    a few tiles are in memory at any time.
+
+    With resume, the existing file at path (from an interrupted
+    download of the same raster) is opened for update instead."""
+
+    def __init__(self, path, bands, height, width, dtype, transform, crs, profile=None, resume=False, **kw):
+        Mosaic.__init__(self, bands, height, width, dtype, transform, crs, **kw)
+        self.path = path
+        self.lock = threading.Lock()
+        if resume:
+            self.dataset = rasterio.open(path, "r+")
+            return
+        profile_kw = dict(gtiff_profile, **compression_profile(dtype))
+        # Blocks never written (missing tiles) read back as nodata
+        profile_kw["SPARSE_OK"] = True
+        profile_kw.update(profile or {})
+        profile_kw.update({"count": bands,
+                           "height": height,
+                           "width": width,
+                           "dtype": dtype,
+                           "transform": transform,
+                           "crs": crs,
+                           "nodata": self.nodata})
+        self.dataset = rasterio.open(path, "w", **profile_kw)
+        if self.scale != 1 or self.offset != 0:
+            self.dataset.scales = [self.scale] * bands
+            self.dataset.offsets = [self.offset] * bands
+
+    def write(self, data, row_off, col_off):
+        clipped, clip_row, clip_col = self.clip(data, row_off, col_off, self.dataset.height, self.dataset.width)
+        window = rasterio.windows.Window(clip_col, clip_row, clipped.shape[2], clipped.shape[1])
+        with self.lock:
+            self.dataset.write(clipped, window=window)
+            self.mark(data, row_off, col_off)
+
+    def checkpoint(self):
+        "Flushes all tiles written so far to disk, by closing and reopening the file"
+        with self.lock:
+            self.dataset.close()
+            self.dataset = rasterio.open(self.path, "r+")
+
+    def close(self):
+        self.dataset.close()
+
+    def result(self):
+        res = Mosaic.result(self)
+        res["path"] = self.path
+        return res
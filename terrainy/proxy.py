@@ -0,0 +1,275 @@
+"""A caching tile proxy, shared by many clients, e.g. the workers of
+a cluster downloading the same areas. It serves the tiles of the
+sources in the source catalog (see sources.py), fetching each tile
+from the server at most once:
+
+  * tiles are kept in one disk cache (see cache.TileCache) for all
+    clients,
+  * identical tile requests arriving while the tile is being fetched
+    wait for that request instead of making their own (see
+    SingleFlight),
+  * the number of concurrent requests to each server is limited for
+    all clients together (see connection.host_concurrency).
+
+    terrainy serve --port 8765
+    TERRAINY_PROXY=http://127.0.0.1:8765 terrainy download ...
+
+Clients request tiles through the proxy by giving their connections
+a proxy URL, see connection.Connection. XYZ tile sources are fetched
+directly, not through the proxy.
+"""
+import concurrent.futures
+import http.server
+import json
+import threading
+import urllib.parse
+from . import cache as tilecache
+from . import connection
+from . import instrument
+from . import sources
+
+default_port = 8765
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: the first caller
+    runs the function, later callers wait for and share its result (or
+    exception). Calls made after it has finished run the function
+    again."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        "Returns (result of fn(), whether it was shared with a call already in flight)"
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result(), True
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result(), False
+
+
+def source_key(definition):
+    "Identifies a source by its connection type, arguments and layer"
+    return json.dumps([definition.get("connection_type"), definition.get("connection_args"),
+                       definition.get("layer")], sort_keys=True, default=str)
+
+
+class UnknownSource(LookupError):
+    "A tile was requested from a source that is not in the catalog"
+
+
+def tile_params(params):
+    "Returns (bounds, tif_res, size) of a tile request"
+    bounds = [float(v) for v in params["bbox"].split(",")]
+    if len(bounds) != 4:
+        raise ValueError("bbox must be xmin,ymin,xmax,ymax")
+    size = (int(params["width"]), int(params["height"]))
+    return bounds, float(params["res"]), size
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, data, content_type, status=200, headers=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        proxy = self.server.proxy
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == "/tile":
+                self.get_tile(proxy, params)
+            elif url.path == "/sources":
+                self.send(json.dumps(proxy.sources(), default=str), "application/json")
+            elif url.path == "/stats":
+                self.send(json.dumps(proxy.stats()), "application/json")
+            else:
+                self.send("Not found", "text/plain", 404)
+        except Exception as e:
+            self.send("Internal error: %s" % e, "text/plain", 500)
+
+    def get_tile(self, proxy, params):
+        try:
+            title = proxy.lookup(params)
+            bounds, tif_res, size = tile_params(params)
+        except UnknownSource as e:
+            return self.send("Unknown source: %s" % e, "text/plain", 404)
+        except KeyError as e:
+            return self.send("Bad request: missing parameter %s" % e, "text/plain", 400)
+        except ValueError as e:
+            return self.send("Bad request: %s" % e, "text/plain", 400)
+        try:
+            data, source = proxy.tile(title, bounds, tif_res, size)
+        except Exception as e:
+            # Only transient failures are reported as such, so that
+            # clients do not retry the others
+            status = 502 if connection.transient(e) else 422
+            return self.send("Upstream request failed: %s" % e, "text/plain", status)
+        self.send(data, "application/octet-stream", headers={"X-Terrainy-Source": source})
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class Proxy(object):
+    """Serves the tiles of the sources in the catalog over HTTP, in a
+    background thread (start()) or the current one (serve_forever()).
+
+    cache is a TileCache, True for the shared connection.tile_cache,
+    or None/False to only coalesce requests. concurrency, if given,
+    sets the number of concurrent requests to each server, for the
+    whole process the proxy runs in, not just the proxy (see
+    connection.set_host_concurrency()).
+
+    Endpoints:
+
+      GET /tile?title=...&bbox=xmin,ymin,xmax,ymax&res=...&width=...&height=...
+          The bytes of a tile, as Connection.fetch_tile() returns
+          them. Instead of title, source can give the source as JSON
+          {"connection_type", "connection_args", "layer"}, which must
+          match a source in the catalog (404 otherwise, 400 if the
+          request is malformed). The X-Terrainy-Source header
+          tells whether the tile came from the "server", the "cache",
+          or was "coalesced" with a request in flight. If the server
+          fails, the status is 502 where retrying might help (see
+          connection.transient()), 422 otherwise.
+      GET /sources
+          The catalog, without coverage geometries.
+      GET /stats
+          The number of tiles served from each of those."""
+
+    def __init__(self, cache=True, concurrency=None, host="127.0.0.1", port=default_port):
+        if cache is True:
+            cache = connection.tile_cache
+        self.cache = cache or None
+        if concurrency is not None:
+            connection.set_host_concurrency(concurrency)
+        self.flight = SingleFlight()
+        # Idle connections by source title, one is checked out by every
+        # request, as they can not be shared between threads
+        self.connections = {}
+        # The first connection to each source, that the others are cloned from
+        self.base = {}
+        self.index = (None, {})
+        self.counts = {"server": 0, "cache": 0, "coalesced": 0}
+        self.lock = threading.Lock()
+        self.server = Server((host, port), Handler)
+        self.server.proxy = self
+        self.url = "http://%s:%s" % (host, self.server.server_address[1])
+        self.thread = None
+
+    def sources(self):
+        catalog = sources.catalog()
+        return {title: {key: value for key, value in row.items() if key != "geometry"}
+                for title, row in catalog.iterrows()}
+
+    def find(self, definition):
+        "Returns the title of the source in the catalog matching definition"
+        catalog = sources.catalog()
+        with self.lock:
+            # Indexed once per version of the catalog
+            if self.index[0] is not catalog:
+                self.index = (catalog, {source_key(row): title for title, row in catalog.iterrows()})
+            titles = self.index[1]
+        key = source_key(definition)
+        if key not in titles:
+            raise UnknownSource(key)
+        return titles[key]
+
+    def lookup(self, params):
+        "Returns the title of the source a tile request is for"
+        if "title" in params:
+            title = params["title"]
+            if title not in sources.catalog().index:
+                raise UnknownSource(title)
+        else:
+            title = self.find(json.loads(params["source"]))
+        if sources.get(title)["connection_type"] == "tile":
+            raise ValueError("XYZ tile sources are not served through the proxy")
+        return title
+
+    def checkout(self, title):
+        with self.lock:
+            idle = self.connections.setdefault(title, [])
+            if idle:
+                return idle.pop()
+        # Create the first connection of a source outside the lock, it
+        # might make network requests (e.g. for capabilities)
+        con = self.base.get(title)
+        if con is None:
+            data = sources.get(title)
+            con = self.base.setdefault(title, connection.connect(cache=self.cache, proxy=False, **data))
+        return con.clone()
+
+    def checkin(self, title, con):
+        with self.lock:
+            self.connections[title].append(con)
+
+    def tile(self, title, bounds, tif_res, size):
+        """Returns (bytes, source) for a tile of a source, where source
+        is "server", "cache" or "coalesced" """
+        con = self.checkout(title)
+        try:
+            key = tilecache.key(**con.tile_key(bounds, tif_res, size))
+            (data, source), shared = self.flight.do(key, lambda: con.fetch_tile_from(bounds, tif_res, size))
+        finally:
+            self.checkin(title, con)
+        if isinstance(data, connection.ArrayTile):
+            # Read from a local file
+            data = data.encode()
+        if shared:
+            source = "coalesced"
+        with self.lock:
+            self.counts[source] += 1
+        return data, source
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def serve_forever(self):
+        instrument.logger.info("Serving %s sources on %s", len(sources.catalog()), self.url)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
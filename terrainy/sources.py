@@ -1,38 +1,147 @@
 import geopandas as gpd
 import pandas as pd
 import os.path
-import pkg_resources
-import traceback
-from . import connection 
+import threading
+import concurrent.futures
+from . import instrument
+
+# connection (and with it rasterio) is imported where needed, so that
+# listing the catalog stays fast
 
 sources_path = os.path.expanduser("~/.config/terrainy/sources.geojson")
+package_sources_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources.geojson")
 
-def load():
-    with pkg_resources.resource_stream("terrainy", "sources.geojson") as f:
-        sources = gpd.read_file(f).set_index("title")
-    if os.path.exists(sources_path):
-        with open(sources_path, "rb") as f:
-            sources = pd.concat((
-                sources,
-                gpd.read_file(f).set_index("title"))
-            )
+# The catalog is parsed once per process, and reparsed only when one
+# of the source files changes. The sources with a valid coverage, and
+# their spatial index, are only built on the first covering() of each
+# version of the catalog.
+_catalog = None
+_catalog_valid = None
+_catalog_signature = None
+_catalog_lock = threading.Lock()
+
+
+def signature():
+    "Identifies the current version of the source files"
+    res = []
+    for path in (package_sources_path, sources_path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            res.append(None)
+        else:
+            res.append((st.st_mtime_ns, st.st_size))
+    return tuple(res)
+
+
+def read():
+    "Parses the source files"
+    frames = []
+    for path in (package_sources_path, sources_path):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                frames.append(gpd.read_file(f).set_index("title"))
+    if not frames:
+        return gpd.GeoDataFrame(
+            {name: [] for name in ("title", "connection_type", "connection_args", "layer", "crs_orig")},
+            geometry=[], crs=4326).set_index("title")
+    sources = pd.concat(frames)
     return sources.loc[~sources.index.duplicated(keep='first')]
 
+
+def catalog():
+    """Returns the cached catalog of sources, indexed by title. This is
+    shared between callers and must not be modified, use load() to get
+    a copy you can change."""
+    global _catalog, _catalog_valid, _catalog_signature
+    sig = signature()
+    with _catalog_lock:
+        if _catalog is None or sig != _catalog_signature:
+            _catalog, _catalog_valid, _catalog_signature = read(), None, sig
+        return _catalog
+
+
+def valid():
+    "Returns the sources of the catalog with a valid coverage, spatially indexed"
+    global _catalog_valid
+    sources = catalog()
+    with _catalog_lock:
+        if _catalog_valid is None or _catalog_valid[0] is not sources:
+            valid = sources.loc[sources.geometry.is_valid]
+            valid.sindex
+            _catalog_valid = (sources, valid)
+        return _catalog_valid[1]
+
+
+def invalidate():
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+def load():
+    return catalog().copy()
+
+
+def get(title):
+    "Returns the source with a given title"
+    return catalog().loc[title]
+
+
+def covering(geometry):
+    "Returns the sources whose coverage contains geometry (in EPSG:4326)"
+    sources = valid()
+    return sources.iloc[sorted(sources.sindex.query(geometry, predicate="within"))]
+
+
 def dump(sources):
     sources_dir = os.path.dirname(sources_path)
     if not os.path.exists(sources_dir):
         os.makedirs(sources_dir)
     sources.to_file(sources_path, driver='GeoJSON')
+    invalidate()
 
-def add_source(**kw):
+def probe_source(**kw):
+    """Connects to a source and determines its crs and coverage.
+    Returns the title and catalog row of the source."""
+    from . import connection
+    # Always ask the server for the crs, see WcsConnection.get_crs()
+    kw.pop("crs_orig", None)
+    title = kw.pop("title")
     con = connection.connect(**kw)
     kw["crs_orig"] = con.get_crs()
     kw["geometry"] = con.get_shape().to_crs(4326).iloc[0].geometry
+    return title, kw
+
+def tune_tile_size(title, tif_res=1, sizes=None):
+    """Measures which tile size gives the best throughput for a source
+    (see connection.Connection.tune_tile_size()), near the middle of
+    its coverage, and remembers it in the catalog as "tile_size"."""
+    from . import connection
+    data = get(title)
+    con = connection.connect(cache=None, **data)
+    center = gpd.GeoSeries([data.geometry.representative_point()], crs=4326).to_crs(con.get_crs()).iloc[0]
+    size = con.tune_tile_size((center.x, center.y), tif_res, sizes)
+    instrument.logger.info("Using tiles of %sx%s pixels for %s", size, size, title)
     s = load()
-    s.loc[kw.pop("title")] = kw
+    s.loc[title, "tile_size"] = size
     dump(s)
+    return size
 
-def add_mapproxy(data):
+def add_source(**kw):
+    title, row = probe_source(**kw)
+    s = load()
+    s.loc[title] = row
+    dump(s)
+
+def add_mapproxy(data, workers=None):
+    """Adds all sources of a mapproxy configuration. Sources are
+    probed by workers threads in parallel, and the catalog is written
+    once at the end."""
+    from . import connection
+    if workers is None:
+        workers = connection.download_workers
+    sources = []
     for title, spec in data["sources"].items():
         try:
             args = {"title": title, "connection_type": spec["type"], "connection_args": {}}
@@ -54,12 +163,26 @@ def add_mapproxy(data):
                 else:
                     args["crs_orig"] = data["grids"][grid]["srs"]
         except Exception as e:
-            print("Parser error for source %s: %s" % (title, e))
-            print("\n".join(("    " + line for line in traceback.format_exc().split("\n"))))
+            instrument.logger.warning("Parser error for source %s: %s", title, e, exc_info=True)
         else:
+            sources.append(args)
+
+    rows = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        futures = {executor.submit(probe_source, **dict(args)): args for args in sources}
+        for future in concurrent.futures.as_completed(futures):
+            args = futures[future]
             try:
-                add_source(**args)
+                title, row = future.result()
             except Exception as e:
-                print("Unable to add source %s: %s: %s" % (
-                    title, args, e))
-                print("\n".join(("    " + line for line in traceback.format_exc().split("\n"))))
+                instrument.logger.warning("Unable to add source %s: %s: %s", args["title"], args, e, exc_info=True)
+            else:
+                rows[title] = row
+
+    if rows:
+        s = load()
+        # Keep the order of the configuration file
+        for args in sources:
+            if args["title"] in rows:
+                s.loc[args["title"]] = rows[args["title"]]
+        dump(s)
@@ -0,0 +1,591 @@
+import concurrent.futures
+import contextlib
+import math
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.shutil
+import rasterio.features
+import rasterio.warp
+import rasterio.windows
+from rasterio.transform import Affine
+from . import instrument
+from . import mosaic
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+
+# Resampling used to build overviews
+overview_resampling = Resampling.average
+
+# Width and height in pixels of the files written by the VRT output
+# mode
+vrt_tile_size = 4096
+
+# Reprojection is done in square windows of the destination grid of
+# this many pixels, warped in parallel by reproject_workers threads
+# (default one per core). Windows are read and warped while the
+# source and destination data of the windows in flight fit in
+# reproject_memory bytes.
+reproject_window_size = 2048
+reproject_workers = None
+reproject_memory = 512 * 1024 ** 2
+
+# Source pixels read around the footprint of each window, per unit of
+# downsampling, for resampling kernels reaching beyond it
+reproject_margin = 4
+
+# GDAL names of numpy data types, for VRT files
+gdal_types = {"uint8": "Byte", "int8": "Int8", "uint16": "UInt16", "int16": "Int16",
+              "uint32": "UInt32", "int32": "Int32", "float32": "Float32", "float64": "Float64"}
+
+
+class Source(object):
+    """The raster returned by Connection.download(), held either in
+    memory or in a file, as a source for reprojection"""
+
+    def __init__(self, data_dict, dataset=None):
+        self.data_dict = data_dict if data_dict is not None else {}
+        self.dataset = dataset
+        self.crs = dataset.crs if data_dict is None else data_dict["data"]["crs_orig"]
+        if dataset is not None:
+            self.count, self.height, self.width = dataset.count, dataset.height, dataset.width
+            self.dtype = dataset.dtypes[0]
+            self.transform = dataset.transform
+            self.nodata = dataset.nodata
+        else:
+            self.count, self.height, self.width = data_dict["array"].shape
+            self.dtype = data_dict["array"].dtype
+            self.transform = data_dict["transform"]
+            self.nodata = data_dict.get("nodata")
+        self.bounds = tuple(rasterio.transform.array_bounds(self.height, self.width, self.transform))
+
+    def bands(self, bands):
+        "Returns the given (1 based) bands, for use as the source of reproject()"
+        if self.dataset is not None:
+            return rasterio.band(self.dataset, bands)
+        array = self.data_dict["array"]
+        if bands == list(range(bands[0], bands[-1] + 1)):
+            # A view, not a copy
+            return array[bands[0] - 1:bands[-1]]
+        return array[[band - 1 for band in bands]]
+
+    def read(self, bands, window):
+        "Reads the given (1 based) bands within window, a rasterio Window with whole pixel offsets and size"
+        if self.dataset is not None:
+            return self.dataset.read(bands, window=window)
+        rows, cols = window.toslices()
+        return self.bands(bands)[:, rows, cols]
+
+    def valid_tiles(self):
+        "Returns the grid of valid tiles (see mosaic.Mosaic) if any tiles are missing, else None"
+        valid_tiles = self.data_dict.get("valid_tiles")
+        if valid_tiles is None or valid_tiles.all():
+            return None
+        return valid_tiles
+
+
+@contextlib.contextmanager
+def open_source(data_dict):
+    "Opens the raster returned by Connection.download() as a Source"
+    if "path" in data_dict:
+        with rasterio.open(data_dict["path"]) as dataset:
+            yield Source(data_dict, dataset)
+    else:
+        yield Source(data_dict)
+
+
+def destination_grid(src, dst_crs, crop_geom=None):
+    """Returns (transform, width, height) of the grid to reproject src
+    to. If crop_geom (in dst_crs) is given, the grid is limited to
+    its bounds."""
+    transform, width, height = calculate_default_transform(
+        src.crs, dst_crs, src.width, src.height, *src.bounds)
+    if crop_geom is None:
+        return transform, width, height
+    window = rasterio.windows.from_bounds(*crop_geom.bounds, transform=transform)
+    window = window.round_offsets(op="floor").round_lengths(op="ceil")
+    window = window.intersection(rasterio.windows.Window(0, 0, width, height))
+    return rasterio.windows.transform(window, transform), int(window.width), int(window.height)
+
+
+class MemoryBudget(object):
+    """Limits the number of bytes held by tasks in flight. A task larger
+    than the whole budget still runs, but only on its own."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.condition:
+            while self.used and self.used + nbytes > self.limit:
+                self.condition.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+
+def source_windows(src, dst_transform, dst_crs, width, height, window_size):
+    """Splits a grid of width x height pixels (dst_transform in dst_crs)
+    into windows of window_size pixels, and yields (dst_window,
+    src_window) for each of them that overlaps src (a Source), where
+    src_window is the part of src needed to reproject it, padded for
+    the resampling kernel.
+
+    The footprints are computed from a lattice of points, window_size
+    / 16 pixels apart, transformed to the pixel grid of src in one
+    go."""
+    step = max(1, window_size // 16)
+    cols = np.unique(np.append(np.arange(0, width, step), width))
+    rows = np.unique(np.append(np.arange(0, height, step), height))
+    xs, ys = dst_transform * np.meshgrid(cols, rows)
+    xs, ys = rasterio.warp.transform(dst_crs, src.crs, xs.ravel(), ys.ravel())
+    src_cols, src_rows = ~src.transform * (np.asarray(xs), np.asarray(ys))
+    src_cols = src_cols.reshape((len(rows), len(cols)))
+    src_rows = src_rows.reshape((len(rows), len(cols)))
+
+    for row_off in range(0, height, window_size):
+        for col_off in range(0, width, window_size):
+            dst_window = rasterio.windows.Window(col_off, row_off, min(window_size, width - col_off),
+                                                 min(window_size, height - row_off))
+            # The lattice points on and within the edges of the window
+            r0 = np.searchsorted(rows, row_off, "right") - 1
+            r1 = np.searchsorted(rows, row_off + dst_window.height)
+            c0 = np.searchsorted(cols, col_off, "right") - 1
+            c1 = np.searchsorted(cols, col_off + dst_window.width)
+            window_cols = src_cols[r0:r1 + 1, c0:c1 + 1]
+            window_rows = src_rows[r0:r1 + 1, c0:c1 + 1]
+            finite = np.isfinite(window_cols) & np.isfinite(window_rows)
+            if not finite.any():
+                continue
+            window_cols, window_rows = window_cols[finite], window_rows[finite]
+            src_width = window_cols.max() - window_cols.min()
+            src_height = window_rows.max() - window_rows.min()
+            downsampling = max(src_width / dst_window.width, src_height / dst_window.height, 1)
+            margin = reproject_margin * math.ceil(downsampling)
+            src_col_off = max(0, math.floor(window_cols.min()) - margin)
+            src_row_off = max(0, math.floor(window_rows.min()) - margin)
+            src_col_end = min(src.width, math.ceil(window_cols.max()) + margin)
+            src_row_end = min(src.height, math.ceil(window_rows.max()) + margin)
+            if src_col_end <= src_col_off or src_row_end <= src_row_off:
+                continue
+            yield dst_window, rasterio.windows.Window(src_col_off, src_row_off, src_col_end - src_col_off,
+                                                      src_row_end - src_row_off)
+
+
+def reproject_windows(src, bands, write, dst_transform, dst_crs, width, height, nodata=None, resampling=None,
+                      workers=None, memory=None, window_size=None, mask=None):
+    """Reprojects the given (1 based) bands of src (a Source) onto a grid
+    of width x height pixels (dst_transform in dst_crs).
+
+    The grid is split into windows of window_size (default
+    reproject_window_size) pixels. For each window only the part of
+    src it covers is read (in the calling thread, as datasets can not
+    be shared between threads), and windows are warped in parallel by
+    workers threads (default reproject_workers), with at most memory
+    (default reproject_memory) bytes of data in flight.
+
+    write(array, window) is called for each reprojected window, one at
+    a time but in no particular order. Windows outside src are never
+    written. If given, mask(window) is called in the worker threads and
+    returns a boolean (height, width) array of the pixels of the window
+    to set to nodata before it is written."""
+    if resampling is None:
+        resampling = Resampling.nearest
+    if workers is None:
+        workers = reproject_workers or os.cpu_count() or 1
+    if window_size is None:
+        window_size = reproject_window_size
+    budget = MemoryBudget(reproject_memory if memory is None else memory)
+    itemsize = np.dtype(src.dtype).itemsize
+    lock = threading.Lock()
+    errors = []
+
+    def warp(source, src_window, dst_window, nbytes):
+        try:
+            array = np.full((len(bands), dst_window.height, dst_window.width),
+                            0 if nodata is None else nodata, dtype=src.dtype)
+            reproject(
+                source=source,
+                destination=array,
+                src_transform=rasterio.windows.transform(src_window, src.transform),
+                src_crs=src.crs,
+                src_nodata=src.nodata,
+                dst_transform=rasterio.windows.transform(dst_window, dst_transform),
+                dst_crs=dst_crs,
+                dst_nodata=nodata,
+                resampling=resampling)
+            if mask is not None:
+                array[:, mask(dst_window)] = nodata
+            with lock:
+                write(array, dst_window)
+        except BaseException as e:
+            errors.append(e)
+            raise
+        finally:
+            budget.release(nbytes)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        futures = []
+        try:
+            for dst_window, src_window in source_windows(src, dst_transform, dst_crs, width, height, window_size):
+                nbytes = len(bands) * itemsize * (src_window.width * src_window.height
+                                                  + dst_window.width * dst_window.height)
+                budget.acquire(nbytes)
+                try:
+                    source = src.read(bands, src_window)
+                except BaseException:
+                    budget.release(nbytes)
+                    raise
+                futures.append(executor.submit(warp, source, src_window, dst_window, nbytes))
+                # Fail early rather than after reading the whole source
+                if errors:
+                    raise errors[0]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def reproject_file(src_path, dst_path, dst_crs, resampling=None, workers=None, memory=None):
+    """Reprojects the raster file at src_path to dst_crs, and writes it
+    to dst_path, window by window, see reproject_windows(). Only a few
+    windows of the raster are ever in memory. GeoTIFF output is
+    tiled, other formats are written through a temporary GeoTIFF,
+    see open_copy()."""
+    with rasterio.open(src_path) as dataset:
+        src = Source(None, dataset)
+        transform, width, height = destination_grid(src, dst_crs)
+        profile = dataset.meta.copy()
+        driver = profile["driver"]
+        profile.update({"crs": dst_crs, "transform": transform, "width": width, "height": height})
+        bands = list(range(1, src.count + 1))
+        if driver == "GTiff":
+            profile.update(mosaic.gtiff_profile)
+            output = rasterio.open(dst_path, "w", **profile)
+        else:
+            profile["driver"] = "GTiff"
+            output = open_copy(dst_path, profile, driver)
+        with output as dst:
+            reproject_windows(src, bands, lambda array, window: dst.write(array, window=window),
+                              transform, dst_crs, width, height, src.nodata, resampling, workers, memory)
+
+
+def dataset_files(path):
+    "Returns the raster file at path and its GDAL sidecar files (e.g. .aux.xml) that exist"
+    with rasterio.open(path) as dataset:
+        return [name for name in dataset.files if os.path.exists(name)]
+
+
+def replace_dataset(src_path, dst_path):
+    """Moves the raster file at src_path, and its sidecar files, to
+    dst_path, replacing the raster there and its sidecar files. The
+    georeferencing of e.g. PNG files is only kept in a sidecar."""
+    old = dataset_files(dst_path) if os.path.exists(dst_path) else []
+    for name in dataset_files(src_path):
+        if name.startswith(src_path):
+            target = dst_path + name[len(src_path):]
+            os.replace(name, target)
+            if target in old:
+                old.remove(target)
+    for name in old:
+        if name != dst_path:
+            os.remove(name)
+
+
+def overview_factors(height, width, blocksize=512):
+    "Decimation factors of overviews down to a size that fits in a single block"
+    factors = []
+    factor = 2
+    while max(height, width) / (factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def set_scales(dst, scale=1, offset=0):
+    "Records the scale and offset of packed values (see Connection.download()) on all bands of dst"
+    if scale != 1 or offset != 0:
+        dst.scales = [scale] * dst.count
+        dst.offsets = [offset] * dst.count
+
+
+@contextlib.contextmanager
+def open_gtiff(out_path, profile, compress=None, predictor=None, overviews=False, scale=1, offset=0):
+    """Opens a tiled, compressed GeoTIFF for writing, window by window.
+    Overviews, if any, are built when it is closed."""
+    profile = dict(mosaic.gtiff_profile, **profile)
+    profile.update(mosaic.compression_profile(profile["dtype"], compress, predictor))
+    with rasterio.open(out_path, "w", **profile) as dst:
+        set_scales(dst, scale, offset)
+        yield dst
+        if overviews:
+            dst.build_overviews(overview_factors(profile["height"], profile["width"]), overview_resampling)
+            dst.update_tags(ns="rio_overview", resampling=overview_resampling.name)
+
+
+@contextlib.contextmanager
+def temporary_gtiff(out_path, profile, compress=None, predictor=None, scale=1, offset=0):
+    """Opens a tiled GeoTIFF next to out_path for writing, and yields it.
+    It is closed and then removed when the block finishes. Use it to
+    write formats GDAL can only copy from an existing dataset,
+    without holding the raster in memory."""
+    tmp_path = out_path + ".tmp.tif"
+    try:
+        with open_gtiff(tmp_path, profile, compress, predictor, False, scale, offset) as dst:
+            yield dst
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_gtiff(array, out_path, profile, compress=None, predictor=None, overviews=False,
+                scale=1, offset=0):
+    "Writes array to a tiled, compressed GeoTIFF, optionally with internal overviews"
+    with open_gtiff(out_path, profile, compress, predictor, overviews, scale, offset) as dst:
+        dst.write(array)
+
+
+def cog_options(dtype, compress=None, predictor=None, overviews=True):
+    """Creation options of the COG driver. overviews is True for
+    overviews down to a single block, False for none, or the number of
+    overview levels."""
+    options = {"BLOCKSIZE": 512,
+               "BIGTIFF": "IF_SAFER",
+               "OVERVIEWS": "AUTO" if overviews else "NONE",
+               "RESAMPLING": overview_resampling.name.upper()}
+    if overviews is not True and overviews:
+        options["OVERVIEW_COUNT"] = int(overviews)
+    options.update({key.upper(): value for key, value
+                    in mosaic.compression_profile(dtype, compress, predictor).items()})
+    return options
+
+
+@contextlib.contextmanager
+def open_cog(out_path, profile, compress=None, predictor=None, overviews=True, scale=1, offset=0):
+    """Opens a Cloud Optimized GeoTIFF for writing, window by window: the
+    raster is written to a temporary GeoTIFF on disk, from which the
+    COG (internally tiled, compressed, with internal overviews, and
+    laid out so that clients can read parts of it with a few range
+    requests) is created when it is closed."""
+    with temporary_gtiff(out_path, profile, compress, predictor, scale, offset) as dst:
+        yield dst
+        dst.close()
+        rasterio.shutil.copy(dst.name, out_path, driver="COG",
+                             **cog_options(profile["dtype"], compress, predictor, overviews))
+
+
+def write_vrt(dataset, out_path, compress=None, predictor=None, overviews=False,
+              scale=1, offset=0, tile_size=None):
+    """Writes dataset as one GeoTIFF per tile of tile_size x tile_size
+    pixels, in a directory next to out_path, with a VRT mosaic of them
+    at out_path. Tiles containing only nodata are not written. Only
+    one tile is read into memory at a time."""
+    if tile_size is None:
+        tile_size = vrt_tile_size
+    bands, height, width = dataset.count, dataset.height, dataset.width
+    dtype = dataset.dtypes[0]
+    nodata = dataset.nodata
+    tiles_dir = os.path.splitext(out_path)[0] + "_tiles"
+    os.makedirs(tiles_dir, exist_ok=True)
+
+    transform = dataset.transform
+    vrt = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(vrt, "SRS").text = dataset.crs.to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(repr(float(v)) for v in transform.to_gdal())
+    vrt_bands = []
+    for band in range(1, bands + 1):
+        vrt_band = ET.SubElement(vrt, "VRTRasterBand", dataType=gdal_types[dtype], band=str(band))
+        if nodata is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(float(nodata))
+        if scale != 1 or offset != 0:
+            ET.SubElement(vrt_band, "Offset").text = repr(float(offset))
+            ET.SubElement(vrt_band, "Scale").text = repr(float(scale))
+        vrt_bands.append(vrt_band)
+
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            window = rasterio.windows.Window(col_off, row_off, min(tile_size, width - col_off),
+                                             min(tile_size, height - row_off))
+            tile = dataset.read(window=window)
+            if nodata is not None and mosaic.nodata_mask(tile, nodata).all():
+                continue
+            name = "%s_%s.tif" % (row_off // tile_size, col_off // tile_size)
+            tile_profile = {"count": bands,
+                            "dtype": dtype,
+                            "crs": dataset.crs,
+                            "nodata": nodata,
+                            "height": tile.shape[1],
+                            "width": tile.shape[2],
+                            "transform": rasterio.windows.transform(window, transform)}
+            write_gtiff(tile, os.path.join(tiles_dir, name), tile_profile, compress, predictor,
+                        overviews, scale, offset)
+            for band, vrt_band in enumerate(vrt_bands, 1):
+                source = ET.SubElement(vrt_band, "SimpleSource")
+                ET.SubElement(source, "SourceFilename", relativeToVRT="1").text = "%s/%s" % (
+                    os.path.basename(tiles_dir), name)
+                ET.SubElement(source, "SourceBand").text = str(band)
+                ET.SubElement(source, "SrcRect", xOff="0", yOff="0",
+                              xSize=str(tile.shape[2]), ySize=str(tile.shape[1]))
+                ET.SubElement(source, "DstRect", xOff=str(col_off), yOff=str(row_off),
+                              xSize=str(tile.shape[2]), ySize=str(tile.shape[1]))
+
+    ET.ElementTree(vrt).write(out_path)
+
+
+@contextlib.contextmanager
+def open_vrt(out_path, profile, compress=None, predictor=None, overviews=False, scale=1, offset=0):
+    """Opens a tiled VRT mosaic (see write_vrt()) for writing, window by
+    window, through a temporary GeoTIFF that is split into tiles when
+    it is closed"""
+    with temporary_gtiff(out_path, profile, compress, predictor, scale, offset) as dst:
+        yield dst
+        dst.close()
+        with rasterio.open(dst.name) as tmp:
+            write_vrt(tmp, out_path, compress, predictor, overviews, scale, offset)
+
+
+@contextlib.contextmanager
+def open_copy(out_path, profile, driver, scale=1, offset=0):
+    """Opens a raster of any other GDAL driver (e.g. PNG) for writing,
+    window by window, through a temporary GeoTIFF that is copied to
+    out_path when it is closed, as many drivers can only copy an
+    existing dataset"""
+    with temporary_gtiff(out_path, profile, scale=scale, offset=offset) as dst:
+        yield dst
+        dst.close()
+        rasterio.shutil.copy(dst.name, out_path, driver=driver)
+
+
+openers = {"GTiff": open_gtiff, "COG": open_cog, "VRT": open_vrt}
+
+
+def open_output(out_path, driver, profile, compress=None, predictor=None, overviews=None, scale=1, offset=0):
+    """Opens out_path for writing window by window with driver, see
+    export_raster(). overviews defaults to True for COG output only."""
+    if driver not in openers:
+        return open_copy(out_path, profile, driver, scale, offset)
+    if overviews is None:
+        overviews = driver == "COG"
+    return openers[driver](out_path, profile, compress, predictor, overviews, scale, offset)
+
+
+def export_raster(data_dict, out_path, dst_crs, crop_geom=None, bands=None, driver="GTiff",
+                  resampling=None, nodata=None, compress=None, predictor=None, overviews=None, callback=None,
+                  workers=None, memory=None):
+    """Reprojects the raster returned by Connection.download() to
+    dst_crs, crops it to crop_geom (a shapely geometry in dst_crs)
+    and writes the result to out_path, all in a single pass.
+
+    Only the part of the destination grid covering crop_geom is ever
+    reprojected, and pixels outside crop_geom are set to nodata. The
+    grid is reprojected in windows in parallel, reading only the parts
+    of the source needed, and each window is masked and written to
+    out_path as soon as it is done, by workers threads with at most
+    memory bytes of data in flight, see reproject_windows(). The
+    destination raster is never held in memory as a whole.
+
+    driver is "GTiff", "COG" (Cloud Optimized GeoTIFF), "VRT" (one
+    GeoTIFF per tile and a VRT mosaic, see write_vrt()) or any other
+    GDAL driver. GeoTIFF output is tiled and compressed with compress
+    (default mosaic.default_compress) using predictor (default chosen from the
+    data type). overviews defaults to True for COG output only.
+
+    The time taken by each stage is reported to callback and returned
+    as a summary, see instrument.Stats. "reproject" is the whole
+    windowed pass, "mask" (missing tiles), "crop" and "write" the
+    time spent on them over all windows, plus for "write" the time
+    taken to finish the output (overviews, COG or VRT)."""
+    if resampling is None:
+        resampling = Resampling.nearest
+    stats = instrument.Stats(callback)
+
+    with open_source(data_dict) as src:
+        if bands is None:
+            bands = list(range(1, src.count + 1))
+        dtype = src.dtype
+        valid_tiles = src.valid_tiles()
+        if nodata is None:
+            nodata = src.nodata
+        if nodata is None and (crop_geom is not None or valid_tiles is not None):
+            nodata = mosaic.default_nodata(dtype)
+
+        transform, width, height = destination_grid(src, dst_crs, crop_geom)
+
+        if valid_tiles is not None:
+            # Reproject the (tiny) grid of valid tiles rather than a per
+            # pixel mask of the source
+            tile_width, tile_length = data_dict["tile_size"]
+            off_col, off_row = data_dict.get("tile_offset", (0, 0))
+            valid_tiles = valid_tiles.astype("uint8")
+            tiles_transform = (src.transform * Affine.translation(-off_col, -off_row)
+                               * Affine.scale(tile_width, tile_length))
+
+        # Time spent on each stage, summed over all windows
+        seconds = {}
+        if valid_tiles is not None:
+            seconds["mask"] = 0.0
+        if crop_geom is not None:
+            seconds["crop"] = 0.0
+        seconds["write"] = 0.0
+        lock = threading.Lock()
+
+        def mask_window(window):
+            "Returns the pixels of window to set to nodata"
+            window_transform = rasterio.windows.transform(window, transform)
+            shape = (window.height, window.width)
+            outside = np.zeros(shape, dtype=bool)
+            if valid_tiles is not None:
+                start = time.perf_counter()
+                valid = np.zeros(shape, dtype="uint8")
+                reproject(
+                    source=valid_tiles,
+                    destination=valid,
+                    src_transform=tiles_transform,
+                    src_crs=src.crs,
+                    dst_transform=window_transform,
+                    dst_crs=dst_crs,
+                    resampling=Resampling.nearest)
+                outside |= valid == 0
+                with lock:
+                    seconds["mask"] += time.perf_counter() - start
+            if crop_geom is not None:
+                start = time.perf_counter()
+                outside |= rasterio.features.geometry_mask([crop_geom], shape, window_transform)
+                with lock:
+                    seconds["crop"] += time.perf_counter() - start
+            return outside
+
+        profile = {"count": len(bands),
+                   "height": height,
+                   "width": width,
+                   "dtype": dtype,
+                   "crs": dst_crs,
+                   "transform": transform,
+                   "nodata": nodata}
+        scale, offset = data_dict.get("scale", 1), data_dict.get("offset", 0)
+        # Windows not written to, outside the source, read as nodata
+        with open_output(out_path, driver, profile, compress, predictor, overviews, scale, offset) as dst:
+            def write_window(array, window):
+                start = time.perf_counter()
+                dst.write(array, window=window)
+                seconds["write"] += time.perf_counter() - start
+
+            with stats.stage("reproject"):
+                reproject_windows(src, bands, write_window, transform, dst_crs, width, height, nodata, resampling,
+                                  workers, memory, mask=mask_window if len(seconds) > 1 else None)
+            finish = time.perf_counter()
+        seconds["write"] += time.perf_counter() - finish
+
+    for stage, value in seconds.items():
+        stats.record(stage, value)
+    return stats.summary()
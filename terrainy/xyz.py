@@ -0,0 +1,135 @@
+import asyncio
+import concurrent.futures
+import os
+import random
+import time
+import warnings
+import numpy as np
+import httpx
+from rasterio import MemoryFile
+from rasterio.errors import NotGeoreferencedWarning
+from . import instrument
+
+# Plain PNG / JPEG tiles carry no georeferencing, we place them ourselves
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning, message=".*no geotransform.*")
+
+# Default number of tile requests in flight at once
+concurrency = 16
+
+# Failed requests (transport errors, 429 and 5xx responses) are
+# retried this many times, with exponential backoff starting at
+# backoff seconds
+retries = 4
+backoff = 0.5
+timeout = 30
+
+retry_status = {429, 500, 502, 503, 504}
+
+
+def decode(data, bands, out=None):
+    """Decodes a PNG / JPEG / GeoTIFF tile into a (bands, height, width)
+    uint8 array. Paletted and grayscale tiles are expanded to RGB.
+
+    If out, an array of that shape (e.g. a view of the mosaic), is
+    given, and the tile has as many bands or more and no palette, the
+    tile is decoded straight into out, which is returned."""
+    with MemoryFile(data) as memfile:
+        with memfile.open() as dataset:
+            colormap = None
+            if dataset.count == 1:
+                try:
+                    colormap = dataset.colormap(1)
+                except ValueError:
+                    colormap = None
+            if (out is not None and colormap is None and dataset.count >= bands
+                    and np.dtype(dataset.dtypes[0]) == out.dtype
+                    and out.shape == (bands, dataset.height, dataset.width)):
+                return dataset.read(list(range(1, bands + 1)), out=out)
+            array = dataset.read()
+            if colormap is not None:
+                lut = np.zeros((256, 4), dtype="uint8")
+                for idx, color in colormap.items():
+                    lut[idx] = color
+                array = np.transpose(lut[array[0]], (2, 0, 1))
+    if array.shape[0] < bands:
+        array = np.concatenate([array] + [array[-1:]] * (bands - array.shape[0]))
+    return array[:bands]
+
+
+async def fetch(client, url):
+    "Downloads url, retrying transient errors. Returns None for missing (404) tiles."
+    for attempt in range(retries + 1):
+        try:
+            response = await client.get(url)
+            if response.status_code == 404:
+                return None
+            if response.status_code not in retry_status:
+                response.raise_for_status()
+                return response.content
+            error = httpx.HTTPStatusError(
+                "Server error %s" % response.status_code, request=response.request, response=response)
+        except httpx.TransportError as e:
+            error = e
+        if attempt == retries:
+            raise error
+        await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+async def fetch_tiles(requests, handle, cache=None, concurrency=concurrency, headers=None, decoders=None):
+    """Downloads tiles over a single pooled HTTP/2 client, with at
+    most concurrency requests in flight.
+
+    requests is a list of (url, tile), and handle(tile, data, info) is
+    called, in a pool of decoders threads (default one per core), with
+    the bytes of each tile as it arrives. info holds "source" ("cache"
+    or "server") and "fetch_seconds", the time it took to get the
+    tile. Tiles are looked up in and added to cache (a
+    cache.TileCache), if given.
+
+    At most concurrency + 2 * decoders tiles are between being
+    requested and handled at a time, so that when handling can not
+    keep up, fetching waits for it instead of queueing tiles in
+    memory."""
+    decoders = decoders or os.cpu_count() or 1
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    backlog = asyncio.Semaphore(concurrency + 2 * decoders)
+    loop = asyncio.get_running_loop()
+
+    async def load(client, url, tile, decoder):
+        async with backlog:
+            key = None
+            data = None
+            source = "cache"
+            start = time.perf_counter()
+            if cache is not None:
+                key = cache.key(url=url)
+                data = await asyncio.to_thread(cache.get, key)
+            if data is None:
+                source = "server"
+                async with semaphore:
+                    start = time.perf_counter()
+                    data = await fetch(client, url)
+                if data is None:
+                    instrument.logger.warning("Missing tile %s", url)
+                    return
+                if cache is not None:
+                    await asyncio.to_thread(cache.put, key, data)
+            info = {"source": source, "fetch_seconds": time.perf_counter() - start}
+            await loop.run_in_executor(decoder, handle, tile, data, info)
+
+    with concurrent.futures.ThreadPoolExecutor(decoders) as decoder:
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout, headers=headers,
+                                     follow_redirects=True) as client:
+            await asyncio.gather(*(load(client, url, tile, decoder) for url, tile in requests))
+
+
+def run(coroutine):
+    """Runs a coroutine to completion, also when called from code
+    already running in an event loop (e.g. a Jupyter notebook)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
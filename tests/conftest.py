@@ -0,0 +1,35 @@
+import geopandas as gpd
+import pytest
+import shapely.geometry
+from terrainy import benchmark
+from terrainy import capabilities
+from terrainy import mockserver
+from terrainy import sources
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    "Keeps the capabilities of the mock server out of the user's cache"
+    monkeypatch.setattr(capabilities, "capabilities_dir", str(tmp_path / "capabilities"))
+
+
+@pytest.fixture(scope="session")
+def server():
+    with mockserver.MockServer() as server:
+        yield server
+
+
+@pytest.fixture
+def catalog(server, tmp_path, monkeypatch):
+    "A source catalog with only the sources of the mock server, titled Mock WCS, Mock WMS and Mock XYZ"
+    monkeypatch.setattr(sources, "package_sources_path", str(tmp_path / "sources.geojson"))
+    monkeypatch.setattr(sources, "sources_path", str(tmp_path / "user-sources.geojson"))
+    benchmark.mock_catalog(server, sources.package_sources_path)
+    sources.invalidate()
+    yield sources.catalog()
+    sources.invalidate()
+
+
+def area(xmin, ymin, xmax, ymax):
+    "A GeoDataFrame with a box, in the crs of the mock server"
+    return gpd.GeoDataFrame(geometry=[shapely.geometry.box(xmin, ymin, xmax, ymax)], crs=mockserver.crs)
@@ -0,0 +1,83 @@
+import os
+from terrainy import cache
+from terrainy import capabilities
+from terrainy import connection
+
+
+def test_cache_returns_what_was_put(tmp_path):
+    tiles = cache.TileCache(str(tmp_path))
+    key = cache.key(bounds=[0, 0, 1, 1], resolution=1.0)
+    assert tiles.get(key) is None
+    tiles.put(key, b"tile")
+    assert tiles.get(key) == b"tile"
+    assert (tiles.hits, tiles.misses) == (1, 1)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    tiles = cache.TileCache(str(tmp_path), max_bytes=1000)
+    keys = [cache.key(tile=idx) for idx in range(12)]
+    for idx, key in enumerate(keys[:10]):
+        tiles.put(key, b"x" * 100)
+        os.utime(tiles.filename(key), (idx, idx))
+    # Used recently, so kept
+    assert tiles.get(keys[0]) is not None
+    tiles.put(keys[10], b"x" * 100)
+    assert tiles.size() <= 1000 * cache.evict_target
+    assert tiles.get(keys[0]) is not None
+    assert tiles.get(keys[1]) is None
+    assert tiles.get(keys[10]) is not None
+
+
+def test_memo_keeps_tiles_until_used_up():
+    memo = cache.TileMemo({"shared": 2, "single": 1})
+    memo.put("shared", b"shared")
+    memo.put("single", b"single")
+    # Only needed once, by the request that put it
+    assert memo.get("single") is None
+    assert memo.get("shared") == b"shared"
+    assert memo.get("shared") is None
+    assert memo.tiles == {}
+
+
+def test_cache_counts_replaced_entries_once(tmp_path):
+    tiles = cache.TileCache(str(tmp_path), max_bytes=1000)
+    key = cache.key(tile=0)
+    tiles.put(cache.key(tile=1), b"x" * 100)
+    for idx in range(20):
+        tiles.put(key, b"x" * 100)
+    assert tiles._size == tiles.size() == 200
+
+
+def test_cache_refreshes_size_before_evicting(tmp_path, monkeypatch):
+    tiles = cache.TileCache(str(tmp_path), max_bytes=1000)
+    other = cache.TileCache(str(tmp_path), max_bytes=1000)
+    keys = [cache.key(tile=idx) for idx in range(10)]
+    for key in keys[:9]:
+        tiles.put(key, b"x" * 100)
+    # Another process empties the cache, so there is nothing to evict
+    other.clear()
+    evictions = []
+    monkeypatch.setattr(tiles, "evict", lambda: evictions.append(1))
+    tiles.put(keys[9], b"x" * 200)
+    assert not evictions
+    assert tiles._size == tiles.size() == 200
+
+
+def test_cached_wms_tiles_need_no_capabilities(server, tmp_path, monkeypatch):
+    tiles = cache.TileCache(str(tmp_path / "tiles"))
+    bounds, size = (550000, 6650000, 550256, 6650256), (256, 256)
+    data = connection.connect(cache=tiles, proxy=False, **server.source("wms")).fetch_tile(bounds, 1, size)
+    # A new process, without the capabilities document
+    monkeypatch.setattr(capabilities, "capabilities_dir", str(tmp_path / "cold"))
+    server.reset()
+    con = connection.connect(cache=tiles, proxy=False, **server.source("wms"))
+    assert con.fetch_tile(bounds, 1, size) == data
+    assert server.requests == 0
+
+
+def test_wms_format_from_connection_args(server, tmp_path):
+    source = server.source("wms")
+    source["connection_args"] = dict(source["connection_args"], format="image/png")
+    con = connection.connect(cache=None, proxy=False, **source)
+    assert con.tile_key((0, 0, 1, 1), 1, (1, 1))["format"] == "image/png"
+    assert con.clone().request_tile((550000, 6650000, 550256, 6650256), 1, (256, 256))
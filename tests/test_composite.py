@@ -0,0 +1,60 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely.geometry
+from rasterio.transform import from_origin
+from terrainy import composite
+from terrainy import connection
+from terrainy import mockserver
+from conftest import area
+
+
+def catalog(*rows):
+    return gpd.GeoDataFrame(list(rows), crs=4326).set_index("title")
+
+
+def coverage(xmin, ymin, xmax, ymax):
+    "A catalog coverage geometry, from a box in the crs of the mock server"
+    return gpd.GeoSeries([shapely.geometry.box(xmin, ymin, xmax, ymax)], crs=mockserver.crs).to_crs(4326).iloc[0]
+
+
+def file_source(tmp_path, title, value, xmin, ymin, xmax, ymax):
+    "A file source with value in every pixel of a box, and no coverage in the catalog"
+    path = str(tmp_path / ("%s.tif" % title))
+    width, height = int(xmax - xmin), int(ymax - ymin)
+    with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                       crs=mockserver.crs, transform=from_origin(xmin, ymax, 1, 1), nodata=-9999) as dataset:
+        dataset.write(np.full((1, height, width), value, dtype="float32"))
+    return {"title": title, "connection_type": "file", "connection_args": {"url": path}, "layer": None,
+            "crs_orig": mockserver.crs, "geometry": None}
+
+
+def test_first_source_has_priority(tmp_path):
+    sources = catalog(file_source(tmp_path, "first", 1, 550000, 6650000, 550400, 6650200),
+                      file_source(tmp_path, "second", 2, 550000, 6650000, 550400, 6650200))
+    res = composite.download(sources, area(550000, 6650000, 550400, 6650200), 1, cache=None)
+    assert (res["array"] == 1).all()
+    assert res["sources"]["second"] == 0
+
+
+def test_nodata_is_filled_from_the_next_source(tmp_path):
+    sources = catalog(file_source(tmp_path, "left", 1, 550000, 6650000, 550200, 6650200),
+                      file_source(tmp_path, "everywhere", 2, 550000, 6650000, 550400, 6650200))
+    res = composite.download(sources, area(550000, 6650000, 550400, 6650200), 1, cache=None)
+    assert res["array"].shape == (1, 200, 400)
+    assert (res["array"][:, :, :200] == 1).all()
+    assert (res["array"][:, :, 200:] == 2).all()
+    assert res["sources"] == {"left": 1, "everywhere": 1}
+
+
+def test_sources_are_fetched_within_their_own_tile_size(server):
+    gdf = area(550000, 6650000, 552000, 6652000)
+    with mockserver.MockServer(max_size=512) as small:
+        secondary = dict(small.source("wms"), title="Small tiles", geometry=coverage(*mockserver.bounds))
+        sources = catalog(dict(server.source("wms"), geometry=coverage(540000, 6640000, 550500, 6660000)),
+                          secondary)
+        res = composite.download(sources, gdf, 1, cache=None)
+        assert small.requests > 0
+    assert res["sources"]["Small tiles"] > 0
+    expected = connection.connect(cache=None, proxy=False, **server.source("wms")).download(gdf, 1)
+    assert np.array_equal(res["array"], expected["array"])
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import requests
+from terrainy import cache
+from terrainy import connection
+from conftest import area
+
+
+def test_client_errors_are_not_retried(server, monkeypatch):
+    monkeypatch.setattr(connection, "tile_backoff", 0)
+    con = connection.connect(cache=None, proxy=False, **server.source("wms"))
+    # Fetches the capabilities
+    con.request_tile((550000, 6650000, 550256, 6650256), 1, (256, 256))
+    server.reset()
+    # Larger than the mock server accepts, which it answers with a 400
+    with pytest.raises(Exception) as error:
+        con.request_tile((550000, 6650000, 555000, 6655000), 1, (5000, 5000))
+    assert not connection.transient(error.value)
+    assert server.requests == 1
+
+
+def test_transient_errors_are_retried(server, monkeypatch):
+    monkeypatch.setattr(connection, "tile_backoff", 0)
+    con = connection.connect(cache=None, proxy=False, **server.source("wcs"))
+    download_tile = con.download_tile
+    calls = []
+
+    def flaky(*args):
+        calls.append(1)
+        if len(calls) < 3:
+            raise requests.ConnectionError("connection reset")
+        return download_tile(*args)
+
+    monkeypatch.setattr(con, "download_tile", flaky)
+    assert con.request_tile((550000, 6650000, 550512, 6650512), 2, (256, 256))
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("connection_type", ["wcs", "wms"])
+def test_throttled_requests_are_retried(server, monkeypatch, connection_type):
+    monkeypatch.setattr(connection, "tile_backoff", 0)
+    con = connection.connect(cache=None, proxy=False, **server.source(connection_type))
+    gdf = area(550000, 6650000, 550512, 6650512)
+    expected = con.download(gdf, 2)
+    server.reset()
+    # owslib passes the 429 on as if it were a tile
+    server.fail(429)
+    res = con.download(gdf, 2)
+    assert server.requests == 2
+    assert np.array_equal(res["array"], expected["array"])
+
+
+def test_failed_responses_are_not_cached(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(connection, "tile_backoff", 0)
+    tiles = cache.TileCache(str(tmp_path / "tiles"))
+    con = connection.connect(cache=tiles, proxy=False, **server.source("wcs"))
+    download_tile = con.download_tile
+    responses = [b"Request failed"]
+
+    def failing_once(*args):
+        # An error page with an image content type, that only fails to open
+        if responses:
+            return responses.pop()
+        return download_tile(*args)
+
+    # Fetches the capabilities
+    con.get_native_grid()
+    monkeypatch.setattr(con, "download_tile", failing_once)
+    gdf = area(550000, 6650000, 550512, 6650512)
+    server.reset()
+    server.fail(429)
+    first = con.download(gdf, 2)
+    # The error page, the 429 and the tile
+    assert len(responses) == 0
+    assert server.requests == 2
+    for mtime, size, filename in tiles.entries():
+        with open(filename, "rb") as f:
+            connection.check_tile(f.read())
+
+    server.reset()
+    second = con.download(gdf, 2)
+    assert server.requests == 0
+    assert np.array_equal(first["array"], second["array"])
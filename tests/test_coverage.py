@@ -0,0 +1,56 @@
+import numpy as np
+import shapely.geometry
+from rasterio import MemoryFile
+from rasterio.transform import from_bounds
+from terrainy import connection
+
+
+class DiskConnection(connection.Connection):
+    "A map with data in a disk of radius 300km, with a pixel missing here and there"
+    file_format = "GeoTIFF"
+
+    def download_tile(self, bounds, tif_res, size):
+        width, height = size
+        xs = bounds[0] + (np.arange(width) + 0.5) * (bounds[2] - bounds[0]) / width
+        ys = bounds[3] - (np.arange(height) + 0.5) * (bounds[3] - bounds[1]) / height
+        xs, ys = np.meshgrid(xs, ys)
+        data = ((xs - 500000) ** 2 + (ys - 7000000) ** 2 < 300000 ** 2).astype("uint8")
+        data[::7, ::5] = 0
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=width, height=height, count=1, dtype="uint8",
+                              crs="EPSG:25833", transform=from_bounds(*bounds, width, height)) as dataset:
+                dataset.write(data[None])
+            return memfile.read()
+
+    def get_bounds(self):
+        return (0, 6000000, 1000000, 8000000)
+
+    def get_crs(self):
+        return "EPSG:25833"
+
+
+def test_coverage_is_compact():
+    con = DiskConnection(cache=None, connection_type="disk", connection_args={"url": "http://disk"})
+    coverage = con.get_shape().geometry.iloc[0]
+    disk = shapely.geometry.Point(500000, 7000000).buffer(300000, 64)
+    assert coverage.geom_type == "Polygon"
+    assert not coverage.interiors
+    assert len(coverage.exterior.coords) < 1000
+    assert coverage.symmetric_difference(disk).area / disk.area < 0.02
+
+
+def test_coverage_fetches_one_empty_tile_per_level():
+    con = DiskConnection(cache=None, connection_type="disk", connection_args={"url": "http://disk"})
+    requests = []
+    download_tile = con.download_tile
+
+    def record(bounds, tif_res, size):
+        requests.append(tuple(bounds))
+        return download_tile(bounds, tif_res, size)
+
+    con.download_tile = record
+    con.get_shape()
+    assert len(requests) == len(set(requests))
+    # Outside the map, at the resolution of each level
+    empty = [bounds for bounds in requests if bounds[2] <= con.get_bounds()[0]]
+    assert len(empty) == len({round(bounds[2] - bounds[0]) for bounds in requests}) > 1
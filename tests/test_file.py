@@ -0,0 +1,39 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from terrainy import connection
+from conftest import area
+
+
+def test_file_tiles_are_read_without_encoding(tmp_path):
+    path = str(tmp_path / "dtm.tif")
+    array = np.arange(400 * 400, dtype="float32").reshape(1, 400, 400)
+    with rasterio.open(path, "w", driver="GTiff", width=400, height=400, count=1, dtype="float32",
+                       crs="EPSG:25833", transform=from_origin(550000, 6650400, 1, 1), nodata=-9999) as dataset:
+        dataset.write(array)
+    con = connection.connect(connection_type="file", connection_args={"url": path}, layer=None)
+    tile = con.request_tile((550100, 6650100, 550200, 6650200), 1, (100, 100))
+    assert isinstance(tile, connection.ArrayTile)
+    assert np.array_equal(tile.array, array[:, 200:300, 100:200])
+
+    res = con.download(area(550000, 6650000, 550400, 6650400), 1)
+    assert res["array"].shape == (1, 400, 400)
+    assert np.array_equal(res["array"], array)
+    # Encoded only to be served through the proxy
+    with connection.open_data(tile.encode()) as dataset:
+        assert dataset.nodata == -9999
+        assert np.array_equal(dataset.read(), tile.array)
+
+
+def test_nan_nodata_is_packed_as_nodata(tmp_path):
+    path = str(tmp_path / "dtm.tif")
+    array = np.full((1, 100, 100), 12.3, dtype="float32")
+    array[:, :, 50:] = np.nan
+    with rasterio.open(path, "w", driver="GTiff", width=100, height=100, count=1, dtype="float32",
+                       crs="EPSG:25833", transform=from_origin(550000, 6650100, 1, 1), nodata=np.nan) as dataset:
+        dataset.write(array)
+    con = connection.connect(connection_type="file", connection_args={"url": path}, layer=None)
+    res = con.download(area(550000, 6650000, 550100, 6650100), 1, dtype="int16", scale=0.1)
+    assert res["array"].dtype == np.int16
+    assert (res["array"][:, :, :50] == 123).all()
+    assert (res["array"][:, :, 50:] == res["nodata"]).all()
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import rasterio.transform
+import rasterio.windows
+import shapely.geometry
+from terrainy import connection
+from conftest import area
+
+
+@pytest.mark.parametrize("tif_res", [2, 3, 5, 10])
+def test_snap_never_fetches_more(server, tif_res):
+    gdf = area(550000, 6650000, 554000, 6654000)
+    results = {}
+    for snap in (False, True):
+        con = connection.connect(cache=None, **server.source("wcs"))
+        results[snap] = con.download(gdf, tif_res, snap=snap)
+    assert results[True]["array"].size <= results[False]["array"].size
+    # Allowing for the headers of a tile more where the grid is shifted
+    assert results[True]["stats"]["bytes"] <= 1.01 * results[False]["stats"]["bytes"]
+
+
+def test_plan_tiles_cover_the_area_once(server):
+    con = connection.connect(cache=None, **server.source("wcs"))
+    grid = con.get_grid(2)
+    aoi = shapely.geometry.box(550123, 6650456, 553789, 6652987)
+    plan = con.plan_tiles(aoi, grid)
+    covered = np.zeros((plan["height"], plan["width"]), dtype=int)
+    for tile in plan["tiles"]:
+        covered[tile.row_off:tile.row_off + tile.height, tile.col_off:tile.col_off + tile.width] += 1
+        window = rasterio.windows.Window(tile.col_off, tile.row_off, tile.width, tile.height)
+        assert rasterio.windows.bounds(window, plan["transform"]) == pytest.approx(tile.bounds)
+    assert (covered == 1).all()
+    xmin, ymin, xmax, ymax = rasterio.transform.array_bounds(plan["height"], plan["width"], plan["transform"])
+    assert xmin <= 550123 < xmin + 2 and xmax - 2 < 553789 <= xmax
+    assert ymin <= 6650456 < ymin + 2 and ymax - 2 < 6652987 <= ymax
+
+
+def test_plan_tiles_are_on_a_fixed_grid(server):
+    con = connection.connect(cache=None, **server.source("wcs"))
+    grid = con.get_grid(2)
+    tile_width, tile_length = grid["tile_size"]
+    bounds = set()
+    for shift in (0, 333, 1777):
+        aoi = shapely.geometry.box(550000 + shift, 6650000 + shift, 554000 + shift, 6654000 + shift)
+        for tile in con.plan_tiles(aoi, grid, trim=False)["tiles"]:
+            assert tile.bounds[0] / (2 * tile_width) == pytest.approx(round(tile.bounds[0] / (2 * tile_width)))
+            assert tile.bounds[3] / (2 * tile_length) == pytest.approx(round(tile.bounds[3] / (2 * tile_length)))
+            bounds.add(tile.bounds)
+    # Overlapping areas share tiles with identical bounds
+    assert len(bounds) < 3 * len(con.plan_tiles(shapely.geometry.box(550000, 6650000, 554000, 6654000), grid,
+                                                trim=False)["tiles"])
+
+
+def test_plan_tiles_skips_tiles_outside_the_area(server):
+    con = connection.connect(cache=None, **server.source("wcs"))
+    grid = con.get_grid(2)
+    # An L shape, leaving out the upper right corner of its bounding box
+    aoi = shapely.geometry.Polygon([(550000, 6650000), (560000, 6650000), (560000, 6652000),
+                                    (552000, 6652000), (552000, 6660000), (550000, 6660000)])
+    plan = con.plan_tiles(aoi, grid)
+    assert plan["skipped"] > 0
+    assert len(plan["tiles"]) + plan["skipped"] == plan["nr_cols"] * plan["nr_rows"]
+    for tile in plan["tiles"]:
+        assert aoi.intersects(shapely.geometry.box(*tile.bounds))
@@ -0,0 +1,40 @@
+import json
+import numpy as np
+import rasterio
+from terrainy import connection
+from terrainy import job
+from conftest import area
+
+
+def test_resume_fetches_only_missing_tiles(server, tmp_path):
+    gdf = area(550000, 6650000, 554000, 6654000)
+    out_path = str(tmp_path / "dtm.tif")
+    con = connection.connect(cache=None, **server.source("wcs"))
+    con.download(gdf, 2, out_path=out_path, resume=True)
+
+    # Forget two tiles, as if the download had been interrupted
+    with open(job.manifest_path(out_path)) as f:
+        manifest = json.load(f)
+    assert set(manifest["tiles"].values()) == {"done"}
+    for tile_id in sorted(manifest["tiles"])[:2]:
+        del manifest["tiles"][tile_id]
+    with open(job.manifest_path(out_path), "w") as f:
+        json.dump(manifest, f)
+
+    server.reset()
+    con.download(gdf, 2, out_path=out_path, resume=True)
+    assert server.requests == 2
+    expected = con.download(gdf, 2)
+    with rasterio.open(out_path) as dataset:
+        assert np.array_equal(dataset.read(), expected["array"])
+
+
+def test_manifest_of_another_request_is_ignored(tmp_path):
+    out_path = str(tmp_path / "dtm.tif")
+    open(out_path, "wb").close()
+    first = job.Job(out_path, {"resolution": 1.0})
+    first.start("float32", -9999)
+    first.done(0, 0)
+    first.save()
+    assert job.Job(out_path, {"resolution": 1.0}).load()
+    assert not job.Job(out_path, {"resolution": 2.0}).load()
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from terrainy import mosaic
+
+
+def test_convert_scales_values():
+    heights = np.array([[[0.0, 12.34, 355.0, -9999.0]]], dtype="float32")
+    res = mosaic.convert(heights, "int16", -9999.0, -32768, scale=0.1)
+    assert res.tolist() == [[[0, 123, 3550, -32768]]]
+
+
+def test_convert_raises_on_overflow():
+    heights = np.array([[[0.0, 355.0, -9999.0]]], dtype="float32")
+    with pytest.raises(ValueError):
+        mosaic.convert(heights, "int16", -9999.0, -32768, scale=0.01)
+
+
+def test_convert_packs_nan_nodata():
+    heights = np.array([[[1.0, np.nan, 3.0]]], dtype="float32")
+    res = mosaic.convert(heights, "int16", np.nan, -32768, scale=0.1)
+    assert res.tolist() == [[[10, -32768, 30]]]
+    # NaN nodata does not hide values that do not fit
+    with pytest.raises(ValueError):
+        mosaic.convert(np.array([[[1.0, np.nan, 4000.0]]]), "int16", np.nan, -32768, scale=0.1)
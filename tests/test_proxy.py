@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+import numpy as np
+import pytest
+import requests
+from terrainy import cache
+from terrainy import connection
+from terrainy import proxy
+from terrainy import sources
+from conftest import area
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = proxy.SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "tile"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", fetch)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", fetch))) for idx in range(4)]
+    for thread in followers:
+        thread.start()
+    # Let the followers reach the call in flight
+    time.sleep(0.2)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(results) == [("tile", False)] + [("tile", True)] * 4
+    # Calls after the one in flight has finished run again
+    assert flight.do("key", fetch) == ("tile", False)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_exceptions():
+    flight = proxy.SingleFlight()
+
+    def fail():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    assert not flight.calls
+
+
+def test_proxy_fetches_each_tile_once(server, catalog, tmp_path):
+    gdf = area(550000, 6650000, 552000, 6652000)
+    data = sources.get("Mock WCS")
+    expected = connection.connect(cache=None, proxy=False, **data).download(gdf, 2)
+    with proxy.Proxy(cache=cache.TileCache(str(tmp_path / "tiles")), port=0) as tile_proxy:
+        server.reset()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            connection.connect(cache=None, proxy=tile_proxy.url, **data).download(gdf, 2)))
+            for idx in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tiles = results[0]["stats"]["tiles"]
+        assert server.requests == tiles
+        assert sum(tile_proxy.stats().values()) == 3 * tiles
+        for res in results:
+            assert np.array_equal(res["array"], expected["array"])
+
+        response = requests.get(tile_proxy.url + "/tile", params={"title": "Unknown", "bbox": "0,0,1,1",
+                                                                 "res": 1, "width": 1, "height": 1})
+        assert response.status_code == 404
+
+
+def test_proxy_does_not_report_client_errors_as_transient(server, catalog, tmp_path):
+    with proxy.Proxy(cache=None, port=0) as tile_proxy:
+        # Fetches the capabilities
+        tile = {"title": "Mock WMS", "bbox": "550000,6650000,550256,6650256", "res": 1, "width": 256, "height": 256}
+        assert requests.get(tile_proxy.url + "/tile", params=tile).status_code == 200
+        server.reset()
+        response = requests.get(tile_proxy.url + "/tile", params=dict(
+            tile, bbox="550000,6650000,555000,6655000", width=5000, height=5000))
+        assert response.status_code == 422
+        assert server.requests == 1
+
+
+def test_proxy_rejects_malformed_requests(server, catalog):
+    tile = {"title": "Mock WCS", "bbox": "550000,6650000,550512,6650512", "res": 2, "width": 256, "height": 256}
+    with proxy.Proxy(cache=None, port=0) as tile_proxy:
+        for params in [{key: value for key, value in tile.items() if key != "bbox"},
+                       dict(tile, bbox="550000,6650000"),
+                       dict(tile, width="wide"),
+                       {key: value for key, value in tile.items() if key != "title"},
+                       dict(tile, title="Mock XYZ")]:
+            assert requests.get(tile_proxy.url + "/tile", params=params).status_code == 400
+        source = {"connection_type": "wcs", "connection_args": {"url": "http://elsewhere/wcs"}, "layer": None}
+        response = requests.get(tile_proxy.url + "/tile", params=dict(
+            {key: value for key, value in tile.items() if key != "title"}, source=json.dumps(source)))
+        assert response.status_code == 404
+
+
+def test_proxy_concurrency_applies_to_known_hosts(monkeypatch):
+    monkeypatch.setattr(connection, "host_concurrency", connection.host_concurrency)
+    monkeypatch.setattr(connection, "host_semaphores", {})
+    assert connection.host_semaphore("example.com").acquire(blocking=False)
+    with proxy.Proxy(cache=None, concurrency=2, port=0):
+        semaphore = connection.host_semaphore("example.com")
+        assert semaphore.acquire(blocking=False)
+        assert semaphore.acquire(blocking=False)
+        assert not semaphore.acquire(blocking=False)
@@ -0,0 +1,24 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.transform import from_origin
+import terrainy
+
+
+def test_reprojected_png_keeps_its_georeferencing(tmp_path):
+    tif = str(tmp_path / "a.tif")
+    png = str(tmp_path / "a.png")
+    with rasterio.open(tif, "w", driver="GTiff", width=400, height=200, count=1, dtype="uint8",
+                       crs="EPSG:25833", transform=from_origin(550000, 6650000, 10, 10)) as dataset:
+        dataset.write(np.arange(400 * 200, dtype="uint32").reshape(1, 200, 400).astype("uint8"))
+    rasterio.shutil.copy(tif, png, driver="PNG")
+    os.remove(tif)
+
+    terrainy.reproject_raster_to_project_crs(png, 4326)
+    assert sorted(os.listdir(tmp_path)) == ["a.png", "a.png.aux.xml"]
+    with rasterio.open(png) as dataset:
+        assert dataset.driver == "PNG"
+        assert dataset.crs.to_epsg() == 4326
+        assert 15 < dataset.transform.c < 16
+        assert dataset.read().any()
@@ -0,0 +1,23 @@
+import threading
+import time
+from terrainy import xyz
+
+
+def test_fetching_waits_for_decoding(server):
+    requests = [("%s/xyz/12/%s/%s.png" % (server.url, 2200 + idx % 8, 1200 + idx // 8), idx) for idx in range(32)]
+    handled = []
+    backlog = []
+    lock = threading.Lock()
+
+    def handle(tile, data, info):
+        # Slower than fetching
+        with lock:
+            time.sleep(0.1)
+            handled.append(tile)
+            backlog.append(server.requests - len(handled))
+
+    server.reset()
+    xyz.run(xyz.fetch_tiles(requests, handle, concurrency=4, decoders=1))
+    assert sorted(handled) == list(range(32))
+    # Tiles fetched but not yet handled
+    assert max(backlog) <= 4 + 2 * 1